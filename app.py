@@ -1,10 +1,27 @@
-from fastapi import FastAPI, UploadFile, Form, File, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, Request, Body
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-import subprocess, os, uuid, shutil, tempfile, json, time, sys
+import subprocess, os, uuid, shutil, tempfile, json, time, sys, hashlib, math, struct, shlex, heapq
 import logging
+import sqlite3
+import threading
 import requests
-from typing import List
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import FIRST_COMPLETED, Future, InvalidStateError, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Callable, List
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow là tuỳ chọn; không có thì chuẩn hoá ảnh bằng FFmpeg
+    Image = ImageOps = None
 
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 logger = logging.getLogger("video-app")
@@ -14,6 +31,9 @@ BASE_DIR = os.path.dirname(__file__)
 STATIC_DIR = os.path.join(BASE_DIR, "static")
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 OUTPUT_DIR = os.path.join(BASE_DIR, "outputs")
+# Thư mục nháp cho từng job (có thể trỏ tới tmpfs/RAM-disk, ví dụ /dev/shm/video-work)
+SCRATCH_DIR = os.environ.get("RENDER_SCRATCH_DIR") or os.path.join(BASE_DIR, "work")
+CACHE_DIR = os.environ.get("CACHE_DIR") or os.path.join(BASE_DIR, "cache")
 
 # Ensure directories exist before mounting
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -28,6 +48,7 @@ app.mount("/VIDEO/outputs", StaticFiles(directory=OUTPUT_DIR), name="video_outpu
 # (kept for safety)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(SCRATCH_DIR, exist_ok=True)
 
 
 def _find_ffmpeg_executable() -> str | None:
@@ -84,8 +105,120 @@ def _find_ffprobe_executable() -> str | None:
     return None
 
 
+# ---------- FFmpeg toolchain registry ----------
+# Tìm ffmpeg/ffprobe và dò khả năng (encoder, hwaccel, filter) một lần lúc khởi động,
+# thay vì quét PATH/WinGet cho mỗi request
+_H264_ENCODER_PREFERENCE = ("libx264", "libopenh264", "h264_videotoolbox", "h264_mf", "mpeg4")
+_toolchain: dict | None = None
+_toolchain_lock = threading.Lock()
+
+
+def _ffmpeg_list_output(ffmpeg_path: str, flag: str) -> List[str]:
+    try:
+        proc = subprocess.run([ffmpeg_path, "-hide_banner", flag], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=15)
+    except Exception:
+        return []
+    return proc.stdout.decode(errors="ignore").splitlines()
+
+
+def _resolve_toolchain() -> dict:
+    ffmpeg_path = _find_ffmpeg_executable()
+    info = {
+        "ffmpeg": ffmpeg_path,
+        "ffprobe": _find_ffprobe_executable(),
+        "version": None,
+        "encoders": set(),
+        "filters": set(),
+        "hwaccels": [],
+        "video_encoder": None,
+        "resolved_at": time.time(),
+    }
+    if not ffmpeg_path:
+        return info
+    version_lines = _ffmpeg_list_output(ffmpeg_path, "-version")
+    if version_lines and version_lines[0].startswith("ffmpeg version "):
+        info["version"] = version_lines[0].split()[2]
+    # " V....D libx264   libx264 H.264 ..." -> tên encoder ở cột thứ 2
+    for line in _ffmpeg_list_output(ffmpeg_path, "-encoders"):
+        parts = line.split()
+        if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] in "VAS":
+            info["encoders"].add(parts[1])
+    # " ..C zoompan   V->V   Apply Zoom & Pan effect."
+    for line in _ffmpeg_list_output(ffmpeg_path, "-filters"):
+        parts = line.split()
+        if len(parts) >= 3 and "->" in parts[2]:
+            info["filters"].add(parts[1])
+    info["hwaccels"] = [l.strip() for l in _ffmpeg_list_output(ffmpeg_path, "-hwaccels")[1:] if l.strip()]
+    info["video_encoder"] = next((e for e in _H264_ENCODER_PREFERENCE if e in info["encoders"]), "libx264")
+    logger.info(f"ffmpeg {info['version']} at {ffmpeg_path}; video encoder={info['video_encoder']}")
+    return info
+
+
+def _get_toolchain(refresh: bool = False) -> dict:
+    global _toolchain
+    with _toolchain_lock:
+        if _toolchain is None or refresh:
+            _toolchain = _resolve_toolchain()
+        return _toolchain
+
+
+def _toolchain_has_filter(name: str) -> bool:
+    filters = _get_toolchain()["filters"]
+    # Không dò được danh sách filter thì coi như có (hành vi cũ)
+    return not filters or name in filters
+
+
+def _toolchain_summary() -> dict:
+    tc = _get_toolchain()
+    return {
+        "ffmpeg": tc["ffmpeg"],
+        "ffprobe": tc["ffprobe"],
+        "version": tc["version"],
+        "video_encoder": tc["video_encoder"],
+        "hwaccels": tc["hwaccels"],
+        "filters": {name: _toolchain_has_filter(name) for name in ("subtitles", "drawtext", "zoompan", "amix", "vignette")},
+        "encoder_count": len(tc["encoders"]),
+        "encoder_profiles": {"available": list(ENCODER_PROFILES), "default": _resolve_encoder_profile(None, False), "preview": _resolve_encoder_profile(None, True)},
+        "resolved_at": tc["resolved_at"],
+    }
+
+
+# Hồ sơ encode: preview/draft ưu tiên tốc độ (ultrafast, fps thấp), archive ưu tiên chất lượng.
+# Nội dung là ảnh tĩnh + zoom chậm nên tune=stillimage và GOP dài không làm giảm chất lượng thấy được.
+# Số luồng không thuộc hồ sơ: mỗi cảnh dùng FFMPEG_THREADS_PER_ENCODE (cũng là con số chia pool
+# encode theo số lõi), lệnh single-pass để FFmpeg tự chọn.
+ENCODER_PROFILES = {
+    "draft": {"preset": "ultrafast", "crf": 32, "tune": "stillimage", "fps": 10, "gop_seconds": 5},
+    "preview": {"preset": "ultrafast", "crf": 28, "tune": "stillimage", "fps": 15, "gop_seconds": 5},
+    "standard": {"preset": "veryfast", "crf": 23, "tune": "stillimage", "fps": 30, "gop_seconds": 2},
+    "archive": {"preset": "slow", "crf": 18, "tune": "stillimage", "fps": 30, "gop_seconds": 2},
+}
+DEFAULT_ENCODER_PROFILE = os.environ.get("ENCODER_PROFILE") or "standard"
+PREVIEW_ENCODER_PROFILE = os.environ.get("PREVIEW_ENCODER_PROFILE") or "preview"
+
+
+def _resolve_encoder_profile(name: str | None, preview: bool) -> str:
+    """Profile name to use for a request; unknown/empty names fall back to the mode default."""
+    name = (name or "").strip().lower()
+    if name in ENCODER_PROFILES:
+        return name
+    fallback = PREVIEW_ENCODER_PROFILE if preview else DEFAULT_ENCODER_PROFILE
+    return fallback if fallback in ENCODER_PROFILES else ("preview" if preview else "standard")
+
+
+def _video_codec_args(profile: dict | None = None) -> List[str]:
+    encoder = _get_toolchain()["video_encoder"] or "libx264"
+    args = ["-c:v", encoder]
+    if profile:
+        if encoder == "libx264":
+            # preset/crf/tune là tuỳ chọn riêng của x264; encoder khác chỉ nhận GOP
+            args += ["-preset", profile["preset"], "-crf", str(profile["crf"]), "-tune", profile["tune"]]
+        args += ["-g", str(max(1, int(profile["fps"] * profile["gop_seconds"])))]
+    return args + ["-pix_fmt", "yuv420p"]
+
+
 def _ffprobe_duration_seconds(media_path: str) -> float | None:
-    ffprobe_path = _find_ffprobe_executable()
+    ffprobe_path = _get_toolchain()["ffprobe"]
     if not ffprobe_path:
         return None
     try:
@@ -105,46 +238,1145 @@ def _ffprobe_duration_seconds(media_path: str) -> float | None:
         return None
 
 
-def _cleanup_generated_files(aggressive: bool = True, older_than_seconds: int = 600) -> None:
-    now = time.time()
-    for base in (UPLOAD_DIR, OUTPUT_DIR):
+# ---------- In-process MP3 duration ----------
+# Bitrate (kbps) theo [MPEG-1?][layer]; MPEG-2/2.5 dùng chung bảng thứ hai
+_MP3_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _mp3_frame_header(data: bytes, pos: int) -> dict | None:
+    """Decode the 4-byte MPEG audio frame header at pos, or None if it is not a valid one."""
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+    version = (data[pos + 1] >> 3) & 0x03  # 3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5
+    layer = 4 - ((data[pos + 1] >> 1) & 0x03)
+    bitrate_idx = data[pos + 2] >> 4
+    rate_idx = (data[pos + 2] >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_idx in (0, 15) or rate_idx == 3:
+        # Free-format bitrate và giá trị dự trữ: để ffprobe xử lý
+        return None
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_idx] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_idx]
+    padding = (data[pos + 2] >> 1) & 0x01
+    if layer == 1:
+        samples, length = 384, (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 3 and not mpeg1:
+        samples, length = 576, 72 * bitrate // sample_rate + padding
+    else:
+        samples, length = 1152, 144 * bitrate // sample_rate + padding
+    mono = (data[pos + 3] >> 6) == 3
+    return {"mpeg1": mpeg1, "layer": layer, "sample_rate": sample_rate, "samples": samples, "length": length, "mono": mono}
+
+
+def _mp3_duration_seconds(path: str) -> float | None:
+    """Duration of an MP3 read from its headers: the Xing/Info or VBRI frame count when
+    present, otherwise a walk over every frame header. None for anything unusual."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    pos = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        # ID3v2: kích thước dạng synchsafe (7 bit mỗi byte), cộng footer nếu có
+        size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+        pos = 10 + size + (10 if data[5] & 0x10 else 0)
+    # Tìm frame đầu tiên (bỏ qua vài byte rác/đệm nếu có)
+    limit = min(len(data), pos + 64 * 1024)
+    while pos < limit and _mp3_frame_header(data, pos) is None:
+        pos += 1
+    first = _mp3_frame_header(data, pos)
+    if first is None:
+        return None
+    # Xing/Info (LAME) nằm sau side info của frame đầu; VBRI (Fraunhofer) luôn ở offset 32
+    if first["layer"] == 3:
+        side_info = (17 if first["mono"] else 32) if first["mpeg1"] else (9 if first["mono"] else 17)
+        tag_pos = pos + 4 + side_info
+        tag = data[tag_pos:tag_pos + 4]
+        if tag in (b"Xing", b"Info") and len(data) >= tag_pos + 12:
+            flags = int.from_bytes(data[tag_pos + 4:tag_pos + 8], "big")
+            if flags & 0x01:
+                frames = int.from_bytes(data[tag_pos + 8:tag_pos + 12], "big")
+                return frames * first["samples"] / first["sample_rate"]
+            # Có tag nhưng thiếu số frame: frame tag không chứa âm thanh, đếm từ frame kế
+            pos += first["length"]
+        vbri_pos = pos + 4 + 32
+        if data[vbri_pos:vbri_pos + 4] == b"VBRI" and len(data) >= vbri_pos + 18:
+            frames = int.from_bytes(data[vbri_pos + 14:vbri_pos + 18], "big")
+            return frames * first["samples"] / first["sample_rate"]
+    samples = 0
+    sample_rate = first["sample_rate"]
+    while True:
+        header = _mp3_frame_header(data, pos)
+        if header is None or header["sample_rate"] != sample_rate:
+            break
+        samples += header["samples"]
+        pos += header["length"]
+    if samples == 0:
+        return None
+    # Chỉ tin kết quả khi đi hết file (trừ tag ID3v1/APE ở cuối)
+    trailing = len(data) - pos
+    if trailing > 0 and data[pos:pos + 3] != b"TAG" and data[pos:pos + 8] != b"APETAGEX" and trailing > 4096:
+        return None
+    return samples / sample_rate
+
+
+def _audio_duration_seconds(media_path: str) -> float | None:
+    """Duration of an audio file; MP3 headers are parsed in-process, ffprobe handles the rest."""
+    duration = _mp3_duration_seconds(media_path)
+    if duration is None:
+        duration = _ffprobe_duration_seconds(media_path)
+    return duration
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, "") or default)
+    except ValueError:
+        return default
+
+
+# ---------- Metrics ----------
+class _Counter:
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                out.append(f"{self.name}{_format_labels(dict(key))} {value:g}")
+        return out
+
+
+class _Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            # [bucket counts..., sum, count]
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = dict(key)
+                for idx, bound in enumerate(self.buckets):
+                    out.append(f"{self.name}_bucket{_format_labels({**labels, 'le': f'{bound:g}'})} {series[idx]}")
+                out.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series[-1]}")
+                out.append(f"{self.name}_sum{_format_labels(labels)} {series[-2]:g}")
+                out.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return out
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+_stage_seconds = _Histogram("render_stage_seconds", "Time spent per render stage.", _SECONDS_BUCKETS)
+_job_seconds = _Histogram("render_job_seconds", "End-to-end render time per job, excluding queue wait.", _SECONDS_BUCKETS)
+_jobs_total = _Counter("render_jobs_total", "Render jobs by final status.")
+_encode_fps = _Histogram("ffmpeg_encode_fps", "Final FFmpeg encode fps per scene clip.", (5, 10, 25, 50, 100, 200, 400, 800))
+_encode_speed = _Histogram("ffmpeg_encode_speed", "Final FFmpeg encode speed (x realtime) per scene clip.", (0.25, 0.5, 1, 2, 4, 8, 16, 32))
+
+
+def _record_span(job: dict | None, stage: str, seconds: float, scene: int | None = None, started: float | None = None, **extra) -> None:
+    _stage_seconds.observe(seconds, stage=stage)
+    if job is not None:
+        span = {"stage": stage, "seconds": round(seconds, 4)}
+        if scene is not None:
+            span["scene"] = scene
+        if started is not None and job.get("started_at"):
+            span["at"] = round(started - job["started_at"], 3)
+        span.update(extra)
+        job.setdefault("spans", []).append(span)
+
+
+@contextmanager
+def _job_span(job: dict | None, stage: str, scene: int | None = None):
+    """Time a block as one stage of a render job (per scene where relevant)."""
+    started = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_span(job, stage, time.perf_counter() - t0, scene, started)
+
+
+def _parse_ffmpeg_progress(output: bytes) -> dict:
+    """Last fps/speed values from FFmpeg `-progress` key=value output."""
+    info: dict[str, float] = {}
+    for line in output.decode(errors="ignore").splitlines():
+        key, _, value = line.partition("=")
+        value = value.strip().rstrip("x")
+        if key in ("fps", "speed"):
+            try:
+                info[key] = float(value)
+            except ValueError:
+                pass
+    return info
+
+
+# ---------- Scene render scheduler ----------
+# Mỗi lần encode libx264 dùng vài luồng; số worker = số core / số luồng mỗi encode
+FFMPEG_THREADS_PER_ENCODE = max(1, _env_int("FFMPEG_THREADS_PER_ENCODE", 2))
+RENDER_WORKERS = max(1, _env_int("RENDER_WORKERS", (os.cpu_count() or 1) // FFMPEG_THREADS_PER_ENCODE))
+_scene_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="scene-render")
+# Job có thể bị huỷ giữa chừng (worker mất lease): các vòng chờ FFmpeg kiểm tra cờ huỷ theo chu kỳ này
+CANCEL_POLL_SECONDS = 0.5
+JOB_CANCELLED_ERROR = "Job đã bị huỷ."
+
+
+class _SceneBatch:
+    """FFmpeg processes belonging to one render, so a failing scene can cancel the rest."""
+
+    def __init__(self) -> None:
+        self.cancelled = threading.Event()
+        self._procs: set[subprocess.Popen] = set()
+        self._lock = threading.Lock()
+
+    def run(self, cmd: List[str]) -> dict:
+        """Run one encode; returns {"code", "stderr", "started", "seconds", "fps", "speed"}."""
+        if self.cancelled.is_set():
+            return {"code": -1, "stderr": b"cancelled"}
+        started = time.time()
+        t0 = time.perf_counter()
+        # -progress ghi fps/speed ra stdout để đo hiệu năng encode
+        proc = subprocess.Popen(cmd[:1] + ["-progress", "pipe:1", "-nostats"] + cmd[1:], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with self._lock:
+            self._procs.add(proc)
         try:
-            for name in os.listdir(base):
-                if name == ".gitignore":
-                    continue
-                path = os.path.join(base, name)
+            if self.cancelled.is_set():
+                proc.terminate()
+            out, err = proc.communicate()
+        finally:
+            with self._lock:
+                self._procs.discard(proc)
+        result = {"code": proc.returncode, "stderr": err, "started": started, "seconds": time.perf_counter() - t0}
+        # Encode quá ngắn chỉ kịp in block progress cuối với fps=0 / speed=0: bỏ qua, đừng kéo lệch histogram
+        result.update({k: v for k, v in _parse_ffmpeg_progress(out).items() if v > 0})
+        if proc.returncode == 0:
+            if "fps" in result:
+                _encode_fps.observe(result["fps"])
+            if "speed" in result:
+                _encode_speed.observe(result["speed"])
+        return result
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        with self._lock:
+            procs = list(self._procs)
+        for proc in procs:
+            try:
+                proc.terminate()
+            except Exception:
+                pass
+
+
+def _run_ffmpeg(cmd: List[str], cancel: threading.Event | None = None) -> subprocess.CompletedProcess:
+    """subprocess.run for one FFmpeg command, terminating it once `cancel` is set."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    while True:
+        try:
+            out, err = proc.communicate(timeout=CANCEL_POLL_SECONDS if cancel else None)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel.is_set():
+                proc.terminate()
+    return subprocess.CompletedProcess(cmd, proc.returncode, out, err)
+
+
+class _ScenePrepError(Exception):
+    """Preparing a scene failed (e.g. TTS); the message is shown to the user as-is."""
+
+
+def _run_scene_encodes(scenes: List[List[str] | Future | None], on_scene_done: Callable[[int, dict | None], None] | None = None,
+                       cancel: threading.Event | None = None) -> str | None:
+    """Run per-scene FFmpeg commands on the shared worker pool.
+    Each entry is a ready command, None when the clip is already in place (cache hit),
+    or a Future resolving to either, or to another such Future (e.g. still waiting for
+    TTS, or for an identical scene another job is encoding); a scene is encoded as
+    soon as its command is available and concat order is unaffected. on_scene_done gets
+    the scene index and the encode result (None for cache hits).
+    Returns None on success, or the error message of the first failure, after cancelling
+    the remaining scenes; setting `cancel` stops the render the same way.
+    """
+    batch = _SceneBatch()
+    preps: dict[Future, int] = {}
+    encodes: dict[Future, int] = {}
+    for i, scene in enumerate(scenes, start=1):
+        if isinstance(scene, Future):
+            preps[scene] = i
+        elif scene is None:
+            if on_scene_done:
+                on_scene_done(i, None)
+        else:
+            encodes[_scene_pool.submit(batch.run, scene)] = i
+    pending = set(preps) | set(encodes)
+    error: str | None = None
+    while pending and error is None:
+        done, pending = wait(pending, timeout=CANCEL_POLL_SECONDS if cancel else None, return_when=FIRST_COMPLETED)
+        if cancel is not None and cancel.is_set():
+            error = JOB_CANCELLED_ERROR
+            break
+        for fut in done:
+            if fut in preps:
                 try:
-                    if aggressive:
-                        if os.path.isdir(path):
-                            shutil.rmtree(path, ignore_errors=True)
-                        else:
-                            os.remove(path)
-                    else:
-                        mtime = os.path.getmtime(path)
-                        if now - mtime > older_than_seconds:
-                            if os.path.isdir(path):
-                                shutil.rmtree(path, ignore_errors=True)
-                            else:
-                                os.remove(path)
-                except Exception:
-                    # best-effort; skip locked files
-                    pass
-        except Exception:
+                    cmd = fut.result()
+                except _ScenePrepError as exc:
+                    error = str(exc)
+                    break
+                except Exception as exc:
+                    error = f"Lỗi chuẩn bị cảnh {preps[fut]}: {exc}"
+                    break
+                if cmd is None:
+                    if on_scene_done:
+                        on_scene_done(preps[fut], None)
+                    continue
+                if isinstance(cmd, Future):
+                    # Cảnh giống hệt đang được job khác encode: chờ tiếp thay vì encode lại
+                    preps[cmd] = preps[fut]
+                    pending.add(cmd)
+                    continue
+                encode = _scene_pool.submit(batch.run, cmd)
+                encodes[encode] = preps[fut]
+                pending.add(encode)
+                continue
+            try:
+                result = fut.result()
+            except Exception as exc:
+                result = {"code": -1, "stderr": str(exc).encode()}
+            if result["code"] != 0:
+                error = f"FFmpeg tạo clip lỗi (ảnh {encodes[fut]}): {result['stderr'].decode(errors='ignore')}"
+                break
+            if on_scene_done:
+                on_scene_done(encodes[fut], result)
+    if error is not None:
+        batch.cancel()
+        for fut in pending:
+            fut.cancel()
+        # Chờ các tiến trình FFmpeg đã bị dừng thoát hẳn, và các bước chuẩn bị đang chạy dở
+        # (không huỷ được) kết thúc, trước khi nhả khoá và xoá workspace
+        wait(pending)
+    return error
+
+
+def _create_job_workspace() -> str:
+    """Private scratch directory for one render (uploads, ASS, TTS audio, clips)."""
+    return tempfile.mkdtemp(prefix="job_", dir=SCRATCH_DIR)
+
+
+# ---------- Upload ingestion ----------
+# Body multipart được đọc thẳng từ request.stream(): giới hạn được kiểm tra trên từng khối byte
+# khi chúng tới, không để Starlette chép hết body vào bộ nhớ/file tạm rồi mới xét
+MAX_UPLOAD_FILE_BYTES = _env_int("MAX_UPLOAD_FILE_BYTES", 50 * 1024 * 1024)
+MAX_UPLOAD_REQUEST_BYTES = _env_int("MAX_UPLOAD_REQUEST_BYTES", 300 * 1024 * 1024)
+MAX_FORM_FIELD_BYTES = _env_int("MAX_FORM_FIELD_BYTES", 1024 * 1024)
+
+
+class _UploadTooLarge(Exception):
+    """An upload went over MAX_UPLOAD_FILE_BYTES, MAX_UPLOAD_REQUEST_BYTES or MAX_FORM_FIELD_BYTES."""
+
+
+class _BadUpload(Exception):
+    """The request body is not a usable multipart/form-data upload."""
+
+
+class _UploadRejected(Exception):
+    """Admission control refused the request part-way through its body."""
+
+    def __init__(self, response: JSONResponse) -> None:
+        super().__init__(response.status_code)
+        self.response = response
+
+
+def _declared_too_large(request: Request) -> bool:
+    """Content-Length already says the body is over MAX_UPLOAD_REQUEST_BYTES."""
+    try:
+        declared = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        declared = 0
+    return declared > MAX_UPLOAD_REQUEST_BYTES
+
+
+def _request_too_large_message() -> str:
+    return f"Tổng dung lượng tải lên vượt quá {MAX_UPLOAD_REQUEST_BYTES // (1024 * 1024)} MB."
+
+
+async def _read_multipart(request: Request, file_dst: Callable[[str, str, dict[str, str]], str | None]) -> tuple[dict[str, str], List[dict]]:
+    """Parse a multipart/form-data body straight from request.stream().
+    Text fields are kept in memory (last value wins); each file part is written to
+    file_dst(field, filename, fields read so far) chunk by chunk and hashed while written
+    (None drops the part; an exception raised there stops reading the body). Every limit is enforced on the raw bytes as they arrive, so an oversized body
+    is refused without being buffered. Returns (fields, files), files in body order as
+    {"field", "filename", "path", "sha256", "size"}.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type") or "")
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise _BadUpload("Yêu cầu phải gửi dạng multipart/form-data.")
+    fields: dict[str, str] = {}
+    files: List[dict] = []
+    part: dict = {}
+    header: dict[str, bytes] = {"field": b"", "value": b""}
+
+    def on_part_begin() -> None:
+        part.clear()
+        part["headers"] = {}
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header["field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header["value"] += data[start:end]
+
+    def on_header_end() -> None:
+        part["headers"][header["field"].decode("latin-1").lower()] = header["value"]
+        header["field"] = header["value"] = b""
+
+    def on_headers_finished() -> None:
+        _disposition, options = parse_options_header(part["headers"].get("content-disposition", b""))
+        part["name"] = options.get(b"name", b"").decode("utf-8", errors="replace")
+        if b"filename" not in options:
+            part["data"] = bytearray()
+            return
+        filename = options[b"filename"].decode("utf-8", errors="replace")
+        path = file_dst(part["name"], filename, fields)
+        part["file"] = {"field": part["name"], "filename": filename, "path": path, "sha256": None, "size": 0}
+        part["hash"] = hashlib.sha256()
+        part["fh"] = open(path, "wb") if path else None
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        chunk = data[start:end]
+        if "file" not in part:
+            part["data"] += chunk
+            if len(part["data"]) > MAX_FORM_FIELD_BYTES:
+                raise _UploadTooLarge(f"Trường {part['name']} vượt quá {MAX_FORM_FIELD_BYTES // 1024} KB.")
+            return
+        part["file"]["size"] += len(chunk)
+        if part["file"]["size"] > MAX_UPLOAD_FILE_BYTES:
+            raise _UploadTooLarge(f"Tệp {part['file']['filename']} vượt quá {MAX_UPLOAD_FILE_BYTES // (1024 * 1024)} MB.")
+        if part["fh"]:
+            part["hash"].update(chunk)
+            part["fh"].write(chunk)
+
+    def on_part_end() -> None:
+        if "file" not in part:
+            fields[part["name"]] = part["data"].decode("utf-8", errors="replace")
+            return
+        if part["fh"]:
+            part["fh"].close()
+            part["file"]["sha256"] = part["hash"].hexdigest()
+            files.append(part["file"])
+        part.clear()
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin, "on_header_field": on_header_field, "on_header_value": on_header_value,
+        "on_header_end": on_header_end, "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data, "on_part_end": on_part_end,
+    })
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_UPLOAD_REQUEST_BYTES:
+                raise _UploadTooLarge(_request_too_large_message())
+            parser.write(chunk)
+        parser.finalize()
+    except ValueError as exc:
+        # MultipartParseError là ValueError: body hỏng hoặc bị cắt giữa chừng
+        raise _BadUpload(f"Body multipart không hợp lệ: {exc}") from exc
+    finally:
+        if part.get("fh"):
+            part["fh"].close()
+    return fields, files
+
+
+def _remove_job_workspace(workspace: str | None) -> None:
+    if workspace:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def _remove_outputs(renditions: List[dict]) -> None:
+    """Delete published files of a render whose result will not be recorded."""
+    for rendition in renditions:
+        try:
+            os.remove(os.path.join(OUTPUT_DIR, os.path.basename(rendition["url"])))
+        except OSError:
             pass
 
 
-def _write_karaoke_ass(text: str, duration_s: float, target_w: int, target_h: int, font_path: str | None, text_color: str = "white", text_effect: str = "kf_fill") -> str:
-    # Build a simple karaoke ASS where words reveal progressively over the full duration.
-    play_res_x, play_res_y = target_w, target_h
-    # Choose a font name hint; libass matches by name
-    font_name = "Arial"
-    if font_path:
+def _publish_output(src_path: str, name: str, job_id: str | None = None) -> str:
+    """Move a finished file from the job workspace into OUTPUT_DIR (works across filesystems)."""
+    dst_path = os.path.join(OUTPUT_DIR, name)
+    if job_id:
+        _retention.claim(dst_path, job_id)
+    shutil.move(src_path, dst_path)
+    return dst_path
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _link_or_copy(src_path: str, dst_path: str) -> None:
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+
+# ---------- Content-addressed disk cache ----------
+# File .tmp còn sót khi process chết giữa lúc chép vào cache được dọn sau khoảng này
+CACHE_TMP_MAX_AGE_SECONDS = 3600
+
+
+class _DiskLRUCache:
+    """Files stored under a content hash with a JSON metadata sidecar.
+    File mtime marks the last use; the least recently used entries are evicted
+    once the total size exceeds max_bytes. put() only adds to a running size
+    total; the directory is scanned when that total crosses max_bytes (the scan
+    also resets it, correcting for other processes sharing the directory).
+    """
+
+    def __init__(self, directory: str, max_bytes: int, suffix: str) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._total: int | None = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        return os.path.join(self.directory, key + self.suffix), os.path.join(self.directory, key + ".json")
+
+    def fetch(self, key: str, dst_path: str) -> dict | None:
+        """Link/copy a cached entry to dst_path and return its metadata, or None on a miss."""
+        data_path, meta_path = self._paths(key)
+        with self._lock:
+            try:
+                _link_or_copy(data_path, dst_path)
+            except OSError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            try:
+                os.utime(data_path, None)
+            except OSError:
+                pass
         try:
-            font_name = os.path.splitext(os.path.basename(font_path))[0] or "Arial"
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
         except Exception:
-            font_name = "Arial"
+            return {}
+
+    def put(self, key: str, src_path: str, meta: dict | None = None) -> None:
+        data_path, meta_path = self._paths(key)
+        tmp_path = f"{data_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            size = os.path.getsize(tmp_path)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta or {}, f)
+            try:
+                replaced = os.path.getsize(data_path)
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, data_path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._total is None:
+                self._evict_locked()
+            else:
+                self._total += size - replaced
+                if self._total > self.max_bytes:
+                    self._evict_locked()
+
+    def _entries(self) -> List[tuple[float, int, str]]:
+        """(mtime, size, key) of every entry; removes stale *.tmp files on the way."""
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                try:
+                    if now - os.path.getmtime(path) > CACHE_TMP_MAX_AGE_SECONDS:
+                        os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name[: -len(self.suffix)]))
+        return entries
+
+    def _evict_locked(self) -> None:
+        entries = sorted(self._entries())
+        total = sum(size for _mtime, size, _key in entries)
+        for _mtime, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            self.evictions += 1
+        self._total = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._entries()
+            self._total = sum(size for _mtime, size, _key in entries)
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "bytes": self._total,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class _InflightKeys:
+    """Cache keys currently being produced. The first caller of claim() owns the key and
+    must resolve() it once the result is in the cache (or the attempt failed); later
+    callers get a Future that completes at that point and then read the cache instead
+    of repeating the work. Used to share encodes/TTS calls across concurrent jobs.
+    """
+
+    def __init__(self) -> None:
+        self._futures: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def claim(self, key: str) -> Future | None:
+        with self._lock:
+            fut = self._futures.get(key)
+            if fut is not None:
+                self.shared += 1
+                return fut
+            self._futures[key] = Future()
+            return None
+
+    def resolve(self, key: str) -> None:
+        with self._lock:
+            fut = self._futures.pop(key, None)
+        if fut is not None:
+            fut.set_result(None)
+
+
+# Clip của từng cảnh, dùng lại khi người dùng render lại mà cảnh đó không đổi
+_scene_cache = _DiskLRUCache(
+    os.environ.get("SCENE_CACHE_DIR") or os.path.join(CACHE_DIR, "scenes"),
+    _env_int("SCENE_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024),
+    ".mp4",
+)
+_scene_inflight = _InflightKeys()
+
+
+# ---------- Source image normalization ----------
+# Ảnh nguồn được giải mã một lần, xoay theo EXIF và thu nhỏ còn vừa khung đích
+# (cộng thêm biên cho mức zoom tối đa 1.06), rồi letterbox sẵn cho zoompan
+ZOOM_MAX = 1.06
+_image_cache = _DiskLRUCache(
+    os.environ.get("IMAGE_CACHE_DIR") or os.path.join(CACHE_DIR, "images"),
+    _env_int("IMAGE_CACHE_MAX_BYTES", 1024 * 1024 * 1024),
+    ".jpg",
+)
+
+
+def _normalized_frame_size(target_w: int, target_h: int) -> tuple[int, int]:
+    # Hai cạnh chẵn (yuv420p) tính từ cùng một hệ số, giữ đúng aspect của khung đích; làm tròn
+    # riêng từng cạnh sẽ lệch aspect. Tỉ lệ tối giản lớn (vd 608x1080) không có cặp chẵn đúng
+    # tuyệt đối gần đó thì lấy cặp lệch ít nhất trong vòng 2% kích thước
+    min_w = 2 * math.ceil(target_w * ZOOM_MAX / 2)
+    best = None
+    for frame_w in range(min_w, max(min_w, int(min_w * 1.02)) + 1, 2):
+        frame_h = 2 * max(1, round(frame_w * target_h / target_w / 2))
+        if frame_h < target_h * ZOOM_MAX:
+            continue
+        error = abs(frame_w * target_h - frame_h * target_w)
+        if best is None or error < best[0]:
+            best = (error, frame_w, frame_h)
+        if error == 0:
+            break
+    if best is None:
+        return min_w, 2 * math.ceil(target_h * ZOOM_MAX / 2)
+    return best[1], best[2]
+
+
+def _normalize_image_pillow(src_path: str, outputs: List[tuple[str, int, int]]) -> bool:
+    """Decode once, then write one letterboxed frame per (dst_path, frame_w, frame_h)."""
+    with Image.open(src_path) as im:
+        # JPEG có thể giải mã thẳng ở độ phân giải thấp hơn (DCT scaling)
+        edge = max(max(w, h) for _dst, w, h in outputs)
+        im.draft("RGB", (edge, edge))
+        im = ImageOps.exif_transpose(im).convert("RGB")
+        for dst_path, frame_w, frame_h in outputs:
+            fitted = ImageOps.contain(im, (frame_w, frame_h), Image.LANCZOS)
+            canvas = Image.new("RGB", (frame_w, frame_h), (0, 0, 0))
+            canvas.paste(fitted, ((frame_w - fitted.width) // 2, (frame_h - fitted.height) // 2))
+            canvas.save(dst_path, "JPEG", quality=90)
+    return True
+
+
+def _normalize_image_ffmpeg(ffmpeg_path: str, src_path: str, dst_path: str, frame_w: int, frame_h: int) -> bool:
+    proc = subprocess.run([
+        ffmpeg_path, "-hide_banner", "-loglevel", "error",
+        "-i", src_path,
+        "-vf", (
+            f"scale=w={frame_w}:h={frame_h}:force_original_aspect_ratio=decrease,"
+            f"pad={frame_w}:{frame_h}:(ow-iw)/2:(oh-ih)/2:color=black"
+        ),
+        "-frames:v", "1", "-q:v", "2", "-y", dst_path,
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return proc.returncode == 0
+
+
+def _normalize_image(ffmpeg_path: str, src_path: str, src_hash: str, targets: List[tuple[int, int]], out_dir: str) -> dict[tuple[int, int], str | None]:
+    """Letterboxed, EXIF-oriented copies of an image sized for the motion stage of each
+    (target_w, target_h), served from the image cache when possible and otherwise decoded
+    once for all sizes. A size maps to None if the image cannot be normalized, in which
+    case the caller falls back to scaling inside the FFmpeg filter chain."""
+    frames: dict[tuple[int, int], str | None] = {}
+    missing: List[tuple[tuple[int, int], str, str, int, int]] = []
+    for target in targets:
+        frame_w, frame_h = _normalized_frame_size(*target)
+        key = _DiskLRUCache.make_key("frame-v2", src_hash, frame_w, frame_h)
+        dst_path = os.path.join(out_dir, f"frame_{key[:16]}_{uuid.uuid4().hex[:8]}.jpg")
+        if _image_cache.fetch(key, dst_path) is not None:
+            frames[target] = dst_path
+        else:
+            missing.append((target, key, dst_path, frame_w, frame_h))
+    if not missing:
+        return frames
+    try:
+        if Image is not None:
+            ok = _normalize_image_pillow(src_path, [(dst, w, h) for _t, _k, dst, w, h in missing])
+        else:
+            ok = all([_normalize_image_ffmpeg(ffmpeg_path, src_path, dst, w, h) for _t, _k, dst, w, h in missing])
+    except Exception:
+        ok = False
+    for target, key, dst_path, _w, _h in missing:
+        if ok and os.path.isfile(dst_path):
+            _image_cache.put(key, dst_path)
+            frames[target] = dst_path
+        else:
+            frames[target] = None
+    return frames
+
+
+# ---------- Ken Burns motion ----------
+# zoompan nhận đúng một frame ảnh đã giải mã (không -loop) và sinh đúng d = duration*fps frame;
+# khung cắt đi theo quỹ đạo tính trước (zoom + điểm neo đầu/cuối) với đường cong easing,
+# nên không còn frame thừa phải bỏ đi bằng -t/-shortest.
+# (zoom đầu, zoom cuối, neo x đầu, neo x cuối, neo y đầu, neo y cuối); neo 0..1 trong phần ảnh dư ra khi zoom
+MOTION_PATHS = {
+    # Mặc định, giữ nguyên giao diện cũ: phóng to đều tới 1.06 trong ~1.3s rồi đứng yên (không theo easing)
+    "zoom_hold": (1.0, ZOOM_MAX, 0.0, 0.0, 0.0, 0.0),
+    "zoom_in": (1.0, ZOOM_MAX, 0.5, 0.5, 0.5, 0.5),
+    "zoom_out": (ZOOM_MAX, 1.0, 0.5, 0.5, 0.5, 0.5),
+    "pan_left": (ZOOM_MAX, ZOOM_MAX, 1.0, 0.0, 0.5, 0.5),
+    "pan_right": (ZOOM_MAX, ZOOM_MAX, 0.0, 1.0, 0.5, 0.5),
+    "pan_up": (ZOOM_MAX, ZOOM_MAX, 0.5, 0.5, 1.0, 0.0),
+    "pan_down": (ZOOM_MAX, ZOOM_MAX, 0.5, 0.5, 0.0, 1.0),
+    "none": (1.0, 1.0, 0.5, 0.5, 0.5, 0.5),
+}
+# Đường cong theo tiến độ p (0..1) của cảnh
+MOTION_EASES = {
+    "linear": "{p}",
+    "ease_in": "{p}*{p}",
+    "ease_out": "{p}*(2-{p})",
+    "ease_in_out": "{p}*{p}*(3-2*{p})",
+}
+DEFAULT_MOTION = "zoom_hold"
+# Easing là tuỳ chọn: chuyển động suốt cảnh làm x264 tốn CPU hơn so với zoom rồi giữ
+DEFAULT_MOTION_EASE = "linear"
+ZOOM_HOLD_STEP = 0.0015  # mỗi frame ở 30 fps
+
+
+def _motion_filter(motion: str, ease: str, frames: int, fps: int, out_w: int, out_h: int, use_zoompan: bool = True) -> str:
+    """Filter turning one still frame into exactly `frames` output frames along the eased
+    Ken Burns path. Static scenes (or FFmpeg without zoompan) scale the still once and repeat it."""
+    if motion not in MOTION_PATHS:
+        motion = DEFAULT_MOTION
+    z0, z1, x0, x1, y0, y1 = MOTION_PATHS[motion]
+    if not use_zoompan or (z0 == z1 == 1.0):
+        # Không chuyển động: không cần zoompan scale lại từng frame
+        return f"scale={out_w}:{out_h},loop=loop={frames - 1}:size=1:start=0,setpts=N/{fps}/TB,fps={fps}"
+    if motion == "zoom_hold":
+        # Bước zoom tỉ lệ nghịch với fps để tốc độ zoom không đổi
+        return f"zoompan=z='min(zoom+{ZOOM_HOLD_STEP * 30 / fps:.6g},{z1:g})':d={frames}:s={out_w}x{out_h}:fps={fps}"
+    eased = (MOTION_EASES.get(ease) or MOTION_EASES[DEFAULT_MOTION_EASE]).format(p=f"min(on/{max(1, frames - 1)},1)")
+
+    def lerp(a: float, b: float) -> str:
+        return f"{a:g}" if a == b else f"{a:g}{b - a:+g}*({eased})"
+
+    return (
+        f"zoompan=z='{lerp(z0, z1)}':x='(iw-iw/zoom)*({lerp(x0, x1)})':y='(ih-ih/zoom)*({lerp(y0, y1)})'"
+        f":d={frames}:s={out_w}x{out_h}:fps={fps}"
+    )
+
+
+# ---------- Retention manager ----------
+# Dọn file nền theo TTL + hạn mức dung lượng, không đụng tới file của job đang chạy
+OUTPUT_TTL_SECONDS = _env_int("OUTPUT_TTL_SECONDS", 24 * 3600)
+SCRATCH_TTL_SECONDS = _env_int("SCRATCH_TTL_SECONDS", 6 * 3600)
+# Asset dùng chung (asset_<sha256> trong UPLOAD_DIR) được batch tham chiếu lại nhiều lần nên giữ lâu hơn file tạm
+ASSET_TTL_SECONDS = _env_int("ASSET_TTL_SECONDS", 7 * 24 * 3600)
+OUTPUT_QUOTA_BYTES = _env_int("OUTPUT_QUOTA_BYTES", 5 * 1024 * 1024 * 1024)
+RETENTION_INTERVAL_SECONDS = max(5, _env_int("RETENTION_INTERVAL_SECONDS", 300))
+
+
+def _path_size(path: str) -> int:
+    if os.path.isdir(path):
+        total = 0
+        for root, _dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class _RetentionManager:
+    """Background janitor for OUTPUT_DIR, UPLOAD_DIR and SCRATCH_DIR.
+    Entries claimed by an active job are never removed; everything else expires
+    after its TTL (shared assets in UPLOAD_DIR have their own, longer one), and
+    published outputs are evicted oldest-first above the quota.
+    """
+
+    def __init__(self) -> None:
+        self._owners: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.reclaimed_bytes = 0
+        self.removed_entries = 0
+        self.last_run: float | None = None
+        self.usage: dict[str, int] = {}
+
+    def claim(self, path: str, job_id: str) -> None:
+        with self._lock:
+            self._owners[os.path.abspath(path)] = job_id
+
+    def release(self, job_id: str) -> None:
+        with self._lock:
+            for path in [p for p, owner in self._owners.items() if owner == job_id]:
+                del self._owners[path]
+
+    def _is_owned(self, path: str) -> bool:
+        with self._lock:
+            return os.path.abspath(path) in self._owners
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("retention pass failed")
+            self._stop.wait(RETENTION_INTERVAL_SECONDS)
+
+    def _remove(self, path: str, size: int) -> None:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            # best-effort; skip locked files
+            return
+        self.reclaimed_bytes += size
+        self.removed_entries += 1
+
+    def run_once(self) -> None:
+        now = time.time()
+        # Job chạy ở process worker khác không tự nhả claim của process web: nhả khi job đã kết thúc
+        with self._lock:
+            owners = set(self._owners.values())
+        for job_id in owners:
+            if _job_queue.finished(job_id):
+                self.release(job_id)
+        for label, base, ttl in (("outputs", OUTPUT_DIR, OUTPUT_TTL_SECONDS), ("uploads", UPLOAD_DIR, SCRATCH_TTL_SECONDS), ("scratch", SCRATCH_DIR, SCRATCH_TTL_SECONDS)):
+            entries = []
+            try:
+                names = os.listdir(base)
+            except OSError:
+                continue
+            for name in names:
+                if name == ".gitignore":
+                    continue
+                path = os.path.join(base, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                entries.append((mtime, _path_size(path), path))
+            kept = []
+            for mtime, size, path in sorted(entries):
+                entry_ttl = ASSET_TTL_SECONDS if base == UPLOAD_DIR and os.path.basename(path).startswith("asset_") else ttl
+                if now - mtime > entry_ttl and not self._is_owned(path):
+                    self._remove(path, size)
+                else:
+                    kept.append((mtime, size, path))
+            total = sum(size for _mtime, size, _path in kept)
+            if base == OUTPUT_DIR and total > OUTPUT_QUOTA_BYTES:
+                for mtime, size, path in kept:
+                    if total <= OUTPUT_QUOTA_BYTES:
+                        break
+                    if self._is_owned(path):
+                        continue
+                    self._remove(path, size)
+                    total -= size
+            self.usage[label] = total
+        self.last_run = now
+
+    def stats(self) -> dict:
+        return {
+            "usage_bytes": dict(self.usage),
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "removed_entries": self.removed_entries,
+            "last_run": self.last_run,
+            "output_ttl_seconds": OUTPUT_TTL_SECONDS,
+            "asset_ttl_seconds": ASSET_TTL_SECONDS,
+            "output_quota_bytes": OUTPUT_QUOTA_BYTES,
+        }
+
+
+_retention = _RetentionManager()
+
+
+# ---------- Font registry ----------
+# Quét FONTS_DIR một lần, đọc tên family thật trong bảng "name" của từng file font.
+# Mỗi font đã dùng có một thư mục riêng chỉ chứa đúng file đó để truyền vào subtitles=fontsdir:
+# libass nạp cả thư mục fontsdir vào bộ nhớ nên không trỏ thẳng vào thư mục font hệ thống.
+if os.name == "nt":
+    _SYSTEM_FONTS_DIR = os.path.join(os.environ.get("WINDIR") or "C:\\Windows", "Fonts")
+else:
+    _SYSTEM_FONTS_DIR = "/usr/share/fonts"
+FONTS_DIR = os.environ.get("FONTS_DIR") or _SYSTEM_FONTS_DIR
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc")
+# Thứ tự ưu tiên khi font_name = "auto"
+DEFAULT_FONTS = ("arial.ttf", "segoeui.ttf", "tahoma.ttf", "dejavusans.ttf")
+_REGULAR_STYLES = ("regular", "book", "normal", "roman")
+
+
+def _decode_font_name(platform_id: int, raw: bytes) -> str:
+    if platform_id in (0, 3):
+        return raw.decode("utf-16-be", errors="ignore")
+    return raw.decode("mac_roman", errors="ignore")
+
+
+def _read_font_names(path: str) -> tuple[str, str] | None:
+    """(family, style) of the first face in a TTF/OTF/TTC file, from its name table."""
+    with open(path, "rb") as f:
+        head = f.read(12)
+        if len(head) < 12:
+            return None
+        offset = 0
+        if head[:4] == b"ttcf":
+            # Bộ sưu tập font: lấy mặt chữ đầu tiên
+            f.seek(12)
+            offset = struct.unpack(">I", f.read(4))[0]
+            f.seek(offset)
+            head = f.read(12)
+        if head[:4] not in (b"\x00\x01\x00\x00", b"OTTO", b"true"):
+            return None
+        num_tables = struct.unpack(">H", head[4:6])[0]
+        records = f.read(16 * num_tables)
+        name_offset = None
+        for n in range(num_tables):
+            tag, _checksum, table_offset, _length = struct.unpack(">4sIII", records[16 * n:16 * n + 16])
+            if tag == b"name":
+                name_offset = table_offset
+                break
+        if name_offset is None:
+            return None
+        f.seek(name_offset)
+        _fmt, count, string_offset = struct.unpack(">HHH", f.read(6))
+        entries = [struct.unpack(">HHHHHH", f.read(12)) for _ in range(count)]
+        found: dict[int, tuple[int, str]] = {}
+        for platform_id, _encoding_id, language_id, name_id, length, str_offset in entries:
+            if name_id not in (1, 2):
+                continue
+            # Ưu tiên Windows/English (US), rồi Windows bất kỳ, rồi Unicode/Mac
+            rank = 0 if (platform_id, language_id) == (3, 0x409) else 1 if platform_id == 3 else 2
+            if name_id in found and found[name_id][0] <= rank:
+                continue
+            f.seek(name_offset + string_offset + str_offset)
+            value = _decode_font_name(platform_id, f.read(length)).strip()
+            if value:
+                found[name_id] = (rank, value)
+    if 1 not in found:
+        return None
+    return found[1][1], found.get(2, (0, "Regular"))[1]
+
+
+class _FontRegistry:
+    """Fonts available for captions, indexed once by file name and family name."""
+
+    def __init__(self, fonts_dir: str, linked_dir: str) -> None:
+        self.fonts_dir = fonts_dir
+        self.linked_dir = linked_dir
+        self._fonts: dict[str, dict] | None = None
+        self._by_family: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def load(self, refresh: bool = False) -> dict[str, dict]:
+        with self._lock:
+            if self._fonts is not None and not refresh:
+                return self._fonts
+            started = time.perf_counter()
+            fonts: dict[str, dict] = {}
+            by_family: dict[str, dict] = {}
+            for root, _dirs, files in os.walk(self.fonts_dir):
+                for name in sorted(files):
+                    if not name.lower().endswith(FONT_EXTENSIONS) or name.lower() in fonts:
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        names = _read_font_names(path)
+                    except (OSError, struct.error):
+                        names = None
+                    if not names:
+                        continue
+                    entry = {"file": name, "family": names[0], "style": names[1], "path": path}
+                    fonts[name.lower()] = entry
+                    # Family trỏ về mặt chữ thường (Regular/Book) nếu có
+                    current = by_family.get(names[0].lower())
+                    if current is None or (current["style"].lower() not in _REGULAR_STYLES and names[1].lower() in _REGULAR_STYLES):
+                        by_family[names[0].lower()] = entry
+            self._fonts, self._by_family = fonts, by_family
+            logger.info("font registry: %d fonts from %s in %.2fs", len(fonts), self.fonts_dir, time.perf_counter() - started)
+            return fonts
+
+    def resolve(self, name: str | None) -> dict | None:
+        """Entry for a file name or family name; "auto"/empty picks the first available default.
+        Returns None for unknown names (see `_caption_font`)."""
+        fonts = self.load()
+        key = (name or "auto").strip().lower()
+        if key == "auto":
+            for candidate in DEFAULT_FONTS:
+                if candidate in fonts:
+                    return fonts[candidate]
+            return next(iter(fonts.values()), None)
+        return fonts.get(key) or self._by_family.get(key)
+
+    def is_known(self, name: str | None) -> bool:
+        return (name or "auto").strip().lower() == "auto" or self.resolve(name) is not None
+
+    def fontsdir(self, entry: dict) -> str | None:
+        """Directory holding only this font file, for `subtitles=...:fontsdir=`."""
+        digest = hashlib.sha256(os.path.abspath(entry["path"]).encode("utf-8")).hexdigest()[:16]
+        out_dir = os.path.join(self.linked_dir, digest)
+        target = os.path.join(out_dir, entry["file"])
+        if not os.path.isfile(target):
+            try:
+                os.makedirs(out_dir, exist_ok=True)
+                _link_or_copy(entry["path"], target)
+            except OSError:
+                return None
+        return out_dir
+
+    def listing(self) -> List[dict]:
+        return [{"file": e["file"], "family": e["family"], "style": e["style"]} for e in sorted(self.load().values(), key=lambda e: (e["family"].lower(), e["style"].lower()))]
+
+
+_font_registry = _FontRegistry(FONTS_DIR, os.path.join(CACHE_DIR, "fonts"))
+
+
+def _caption_font(name: str | None) -> str:
+    """font_name to queue: unknown fonts fall back to the default family (as before the
+    registry existed) with a warning instead of failing the request."""
+    if _font_registry.is_known(name):
+        return name or "auto"
+    logger.warning("font %r not found in %s; using the default caption font", name, FONTS_DIR)
+    return "auto"
+
+
+def _subtitles_filter(ass_path: str, fonts_dir: str | None) -> str:
+    flt = f"subtitles='{_escape_path_for_drawtext(ass_path)}'"
+    if fonts_dir:
+        flt += f":fontsdir='{_escape_path_for_drawtext(fonts_dir)}'"
+    return flt
+
+
+@lru_cache(maxsize=64)
+def _ass_header(target_w: int, target_h: int, font_family: str | None, text_color: str = "white") -> str:
+    """[Script Info] + [V4+ Styles] + [Events] format line; built once per resolution/font/color."""
+    # libass matches by family name, read from the font file by the registry
+    font_name = font_family or "Arial"
     # Keep subtitle size modest relative to video
-    base_font_size = max(22, int(target_h * 0.045))
+    base_font_size = _ass_font_size(target_h)
     # Resolve color
     hex_ass = _css_hex_to_ass_bgr(text_color)
     if hex_ass:
@@ -165,73 +1397,101 @@ def _write_karaoke_ass(text: str, duration_s: float, target_w: int, target_h: in
     secondary = chosen_ass
     outline = "&H00000000"      # black
     back = "&H64000000"         # shadow
+    logger.info(f"subtitle style {target_w}x{target_h} color={text_color} font={font_name}")
+    return "\n".join([
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {target_w}",
+        f"PlayResY: {target_h}",
+        "ScaledBorderAndShadow: yes",
+        "WrapStyle: 2",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding",
+        f"Style: Default,{font_name},{base_font_size},{primary},{secondary},{outline},{back},0,0,0,0,100,100,0,0,1,3,2,2,30,30,{max(20, int(target_h*0.08))},0",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+        "",
+    ])
+
+
+def _ass_font_size(target_h: int) -> int:
+    return max(22, int(target_h * 0.045))
 
+
+def _ass_wrap(text: str, target_w: int, target_h: int) -> List[str]:
+    """Greedy word wrap to what fits in ~90% of the frame width at the style's font size."""
+    # Ước lượng bề rộng trung bình một ký tự ~0.55 cỡ chữ (đủ cho Latin có dấu)
+    max_chars = max(8, int(target_w * 0.9 / (_ass_font_size(target_h) * 0.55)))
+    lines: List[str] = []
+    current = ""
+    for word in text.split():
+        if current and len(current) + 1 + len(word) > max_chars:
+            lines.append(current)
+            current = word
+        else:
+            current = f"{current} {word}" if current else word
+    if current:
+        lines.append(current)
+    return lines or [text]
+
+
+def _ass_time(t: float) -> str:
+    cs_total = int(round(max(0.0, t) * 100))
+    h, rest = divmod(cs_total, 360000)
+    m, rest = divmod(rest, 6000)
+    s, cs = divmod(rest, 100)
+    return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
+
+
+def _ass_event(text: str, start_s: float, end_s: float, target_w: int, target_h: int, text_effect: str = "kf_fill", fade_ms: int = 0) -> str:
+    """One Dialogue line animating `text` per text_effect between start_s and end_s (global time)."""
+    duration_s = max(0.01, end_s - start_s)
     total_cs = max(1, int(duration_s * 100))
-    try:
-        logger.info(f"subtitle effect={text_effect} color={text_color} font={font_name}")
-    except Exception:
-        pass
-    words = [w for w in text.split() if w] or [text]
+    lines = _ass_wrap(text, target_w, target_h)
     dialogue_prefix = ""  # extra ASS tags before the text
     if text_effect == "k_word":
         # per-word karaoke
+        words = [w for line in lines for w in line.split()] or [text]
         lengths = [max(1, len(w)) for w in words]
         total_len = sum(lengths)
         k_values = [max(1, int(total_cs * L / total_len)) for L in lengths]
         drift = total_cs - sum(k_values)
         if drift != 0:
             k_values[-1] = max(1, k_values[-1] + drift)
-        karaoke_segments = [f"{{\\k{k}}}{w}" for w, k in zip(words, k_values)]
-        karaoke_line = " ".join(karaoke_segments)
+        segments = iter(f"{{\\k{k}}}{w}" for w, k in zip(words, k_values))
+        karaoke_line = "\\N".join(" ".join(next(segments) for _ in line.split()) for line in lines)
     elif text_effect == "typewriter":
         # reveal characters progressively using \k per char
-        chars = list(text)
-        lengths = [1 for _ in chars]
-        k_each = max(1, int(total_cs / max(1, len(chars))))
-        karaoke_segments = [f"{{\\k{k_each}}}{c}" for c in chars]
-        karaoke_line = "".join(karaoke_segments)
+        k_each = max(1, int(total_cs / max(1, sum(len(line) for line in lines))))
+        karaoke_line = "\\N".join("".join(f"{{\\k{k_each}}}{c}" for c in line) for line in lines)
     elif text_effect == "fade_in":
         # simple fade in on the whole line
-        karaoke_line = text
+        karaoke_line = "\\N".join(lines)
         dialogue_prefix = "{\\alpha&HFF&\\t(0,700,\\alpha&H00&)}"
     elif text_effect == "pop":
         # pop scale: 0 -> 130% -> 100%
-        karaoke_line = text
+        karaoke_line = "\\N".join(lines)
         dialogue_prefix = "{\\fscx0\\fscy0\\t(0,300,\\fscx130\\fscy130)\\t(300,600,\\fscx100\\fscy100)}"
     else:
-        # default smooth fill with \kf
-        karaoke_line = f"{{\\kf{total_cs}}}{text}"
-
-    end_s = max(0.01, duration_s)
-    def _fmt(t: float) -> str:
-        cs = int(round((t - int(t)) * 100))
-        s = int(t) % 60
-        m = (int(t) // 60) % 60
-        h = int(t) // 3600
-        return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
-
-    header = [
-        "[Script Info]",
-        "ScriptType: v4.00+",
-        f"PlayResX: {play_res_x}",
-        f"PlayResY: {play_res_y}",
-        "ScaledBorderAndShadow: yes",
-        "",
-        "[V4+ Styles]",
-        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding",
-        f"Style: Default,{font_name},{base_font_size},{primary},{secondary},{outline},{back},0,0,0,0,100,100,0,0,1,3,2,2,30,30,{max(20, int(target_h*0.08))},0",
-        "",
-        "[Events]",
-        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
-        f"Dialogue: 0,{_fmt(0.0)},{_fmt(end_s)},Default,,0,0,0,,{{\\bord3\\shad2}}{dialogue_prefix}{karaoke_line}",
-        "",
-    ]
+        # default smooth fill with \kf, chia theo độ dài từng dòng để dòng sau chỉ tô khi dòng trước xong
+        total_len = max(1, sum(len(line) for line in lines))
+        karaoke_line = "\\N".join(f"{{\\kf{max(1, int(total_cs * len(line) / total_len))}}}{line}" for line in lines)
+    fade = f"\\fad({fade_ms},{fade_ms})" if fade_ms else ""
+    return f"Dialogue: 0,{_ass_time(start_s)},{_ass_time(end_s)},Default,,0,0,0,,{{\\bord3\\shad2{fade}}}{dialogue_prefix}{karaoke_line}"
+
+
+def _write_ass(path: str, header: str, events: List[str]) -> str:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(header + "\n".join(events) + "\n")
+    return path
+
 
-    fd, ass_path = tempfile.mkstemp(suffix=".ass", dir=OUTPUT_DIR)
-    os.close(fd)
-    with open(ass_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(header))
-    return ass_path
+def _write_karaoke_ass(text: str, duration_s: float, target_w: int, target_h: int, font_family: str | None, text_color: str = "white", text_effect: str = "kf_fill", *, out_dir: str, name: str = "captions.ass") -> str:
+    """Single-event ASS for one clip (multipass engine), written to out_dir/name."""
+    event = _ass_event(text, 0.0, max(0.01, duration_s), target_w, target_h, text_effect)
+    return _write_ass(os.path.join(out_dir, name), _ass_header(target_w, target_h, font_family, text_color), [event])
 
 
 def _escape_for_drawtext_text(s: str) -> str:
@@ -285,37 +1545,126 @@ def _css_hex_to_ass_bgr(color: str) -> str | None:
     return None
 
 
-def _synthesize_tts_mp3(text: str, voice: str) -> str | None:
+TTS_MODEL = "gpt-4o-mini-tts"
+TTS_FORMAT = "mp3"
+# Số request TTS chạy đồng thời (toàn server), timeout và số lần thử kết nối lại mỗi request
+TTS_MAX_INFLIGHT = max(1, _env_int("TTS_MAX_INFLIGHT", 6))
+TTS_TIMEOUT_SECONDS = max(1, _env_int("TTS_TIMEOUT_SECONDS", 60))
+TTS_RETRIES = max(0, _env_int("TTS_RETRIES", 2))
+_tts_pool = ThreadPoolExecutor(max_workers=TTS_MAX_INFLIGHT, thread_name_prefix="tts")
+# Một session keep-alive dùng chung thay vì mở kết nối mới cho mỗi dòng
+_tts_session = requests.Session()
+# Adapter chỉ thử lại lỗi kết nối (request chưa tới server); POST lỗi 5xx/timeout không lặp lại
+# ở đây mà để supervisor chuyển sang engine khác, tránh số lần thử cộng dồn
+_tts_adapter = HTTPAdapter(
+    pool_maxsize=TTS_MAX_INFLIGHT,
+    max_retries=Retry(
+        total=TTS_RETRIES,
+        connect=TTS_RETRIES,
+        read=0,
+        status=0,
+        backoff_factor=0.5,
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    ),
+)
+_tts_session.mount("http://", _tts_adapter)
+_tts_session.mount("https://", _tts_adapter)
+_tts_cache = _DiskLRUCache(
+    os.environ.get("TTS_CACHE_DIR") or os.path.join(CACHE_DIR, "tts"),
+    _env_int("TTS_CACHE_MAX_BYTES", 512 * 1024 * 1024),
+    ".mp3",
+)
+_tts_inflight = _InflightKeys()
+
+
+def _synthesize_tts_mp3(text: str, voice: str, out_dir: str) -> str | None:
     """Call a local openai-edge-tts compatible server to synthesize MP3.
-    Returns path to a temporary mp3 file, or None on failure.
+    The backend is picked by the TTS supervisor (least outstanding requests); a failed
+    request is retried once on another backend when the pool has more than one.
+    Returns path to a temporary mp3 file inside out_dir, or None on failure.
     """
-    # Default to 5050 per openai-edge-tts config unless TTS_BASE_URL is set
-    base_url = os.environ.get("TTS_BASE_URL", "http://127.0.0.1:5050")
-    url = f"{base_url.rstrip('/')}/v1/audio/speech"
     payload = {
-        "model": "gpt-4o-mini-tts",
+        "model": TTS_MODEL,
         "voice": voice,
         "input": text,
-        "format": "mp3",
+        "format": TTS_FORMAT,
     }
-    try:
-        api_key = os.environ.get("TTS_API_KEY", "local")
-        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
-        resp = requests.post(url, headers=headers, data=json.dumps(payload), timeout=60)
-        if resp.status_code != 200:
-            return None
-        mp3_bytes = resp.content
-        fd, temp_path = tempfile.mkstemp(suffix=".mp3", dir=OUTPUT_DIR)
-        os.close(fd)
-        with open(temp_path, "wb") as f:
-            f.write(mp3_bytes)
-        return temp_path
-    except Exception:
-        return None
+    api_key = os.environ.get("TTS_API_KEY", "local")
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+    tried: set[str] = set()
+    for _attempt in range(min(2, _tts_supervisor.size)):
+        backend = _tts_supervisor.acquire(exclude=tried)
+        tried.add(backend["url"])
+        ok = False
+        try:
+            resp = _tts_session.post(f"{backend['url']}/v1/audio/speech", headers=headers, data=json.dumps(payload), timeout=(5, TTS_TIMEOUT_SECONDS))
+            # 4xx (giọng/nội dung không hợp lệ) không phải lỗi của backend
+            ok = resp.status_code < 500
+            if resp.status_code != 200:
+                continue
+            mp3_bytes = resp.content
+            fd, temp_path = tempfile.mkstemp(suffix=".mp3", dir=out_dir)
+            os.close(fd)
+            with open(temp_path, "wb") as f:
+                f.write(mp3_bytes)
+            return temp_path
+        except Exception:
+            continue
+        finally:
+            _tts_supervisor.release(backend, ok)
+    return None
+
 
+def _tts_audio(text: str, voice: str, out_dir: str, job: dict | None = None) -> tuple[str, float | None] | None:
+    """TTS audio for one line plus its measured duration, served from the disk cache when possible.
+    Returns (mp3 path inside out_dir, duration seconds) or None on failure.
+    """
+    key = _DiskLRUCache.make_key(text, voice, TTS_MODEL, TTS_FORMAT)
+    audio_path = os.path.join(out_dir, f"tts_{key[:16]}_{uuid.uuid4().hex[:8]}.mp3")
 
-# ---------- Auto-start local TTS server (openai-edge-tts) ----------
-_tts_proc: subprocess.Popen | None = None
+    def _cached() -> tuple[str, float | None] | None:
+        meta = _tts_cache.fetch(key, audio_path)
+        if meta is None:
+            return None
+        duration = meta.get("duration")
+        if duration is None:
+            with _job_span(job, "duration"):
+                duration = _audio_duration_seconds(audio_path)
+        return audio_path, duration
+
+    cached = _cached()
+    if cached:
+        return cached
+    waiter = _tts_inflight.claim(key)
+    if waiter is not None:
+        # Cùng câu + giọng đang được đọc cho cảnh/video khác: chờ rồi lấy từ cache
+        waiter.result()
+        cached = _cached()
+        if cached:
+            return cached
+    try:
+        synthesized = _synthesize_tts_mp3(text, voice, out_dir)
+        if not synthesized:
+            return None
+        with _job_span(job, "duration"):
+            duration = _audio_duration_seconds(synthesized)
+        _tts_cache.put(key, synthesized, {"duration": duration, "text": text, "voice": voice})
+        return synthesized, duration
+    finally:
+        if waiter is None:
+            _tts_inflight.resolve(key)
+
+
+# ---------- Local TTS backend pool (openai-edge-tts) ----------
+# TTS_POOL_SIZE tiến trình TTS trên các cổng liên tiếp từ cổng của TTS_BASE_URL.
+# TTS_BACKEND_CMD thay lệnh mặc định (openai-edge-tts), ví dụ server giả lập để thử nghiệm:
+#   TTS_BACKEND_CMD="{python} benchmarks/stub_tts.py --port {port}"
+# DISABLE_TTS_AUTOSTART=1: không tự chạy tiến trình nào, chỉ cân tải giữa các cổng đã có người chạy sẵn.
+TTS_POOL_SIZE = max(1, _env_int("TTS_POOL_SIZE", 1))
+TTS_BACKEND_CMD = os.environ.get("TTS_BACKEND_CMD", "")
+TTS_HEALTH_INTERVAL_SECONDS = max(1, _env_int("TTS_HEALTH_INTERVAL_SECONDS", 5))
+TTS_STARTUP_TIMEOUT_SECONDS = max(1, _env_int("TTS_STARTUP_TIMEOUT_SECONDS", 20))
 
 
 def _is_tts_alive(base_url: str) -> bool:
@@ -327,77 +1676,288 @@ def _is_tts_alive(base_url: str) -> bool:
         return False
 
 
-def _ensure_tts_server_running() -> None:
-    global _tts_proc
-    if os.environ.get("DISABLE_TTS_AUTOSTART", "0") in ("1", "true", "TRUE"):
-        return
-
-    base_url = os.environ.get("TTS_BASE_URL", "http://127.0.0.1:5050").rstrip("/")
-    if _is_tts_alive(base_url):
-        logger.info(f"TTS already running at {base_url}")
-        return
-
-    candidate_dir = os.path.join(BASE_DIR, "openai-edge-tts")
-    entry_alt = os.path.join(candidate_dir, "app", "server.py")
-    if os.path.isfile(entry_alt):
-        cmd = [sys.executable, "app\\server.py"]
-        cwd = candidate_dir
-    else:
-        logger.warning("openai-edge-tts not found; skipping TTS autostart")
-        return
+def _tts_autostart_enabled() -> bool:
+    return os.environ.get("DISABLE_TTS_AUTOSTART", "0") not in ("1", "true", "TRUE")
+
+
+class _TTSSupervisor:
+    """Pool of TTS backends: spawns and restarts the managed processes, keeps a cached
+    health state from background probes, and hands out the healthy backend with the
+    fewest in-flight requests."""
+
+    def __init__(self, base_url: str, size: int) -> None:
+        base_url = base_url.rstrip("/")
+        scheme_host, _, port = base_url.rpartition(":")
+        if not port.isdigit():
+            # URL không ghi cổng: chỉ một backend, không tự chạy thêm được
+            scheme_host, port, size = base_url, "", 1
+        self.size = size
+        self.backends = [
+            {
+                "url": f"{scheme_host}:{int(port) + n}" if port else scheme_host,
+                "port": int(port) + n if port else None,
+                "proc": None,
+                "managed": False,
+                "healthy": True,  # chưa probe: coi như sống để request đầu tiên không bị chặn
+                "outstanding": 0,
+                "served": 0,
+                "failures": 0,
+                "restarts": 0,
+                "started_at": None,
+                "last_probe": None,
+            }
+            for n in range(size)
+        ]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def urls(self) -> List[str]:
+        return [b["url"] for b in self.backends]
+
+    def _command(self, port: int) -> tuple[List[str], str] | None:
+        if TTS_BACKEND_CMD:
+            cmd = TTS_BACKEND_CMD.format(port=port, python=sys.executable)
+            return shlex.split(cmd, posix=os.name != "nt"), BASE_DIR
+        candidate_dir = os.path.join(BASE_DIR, "openai-edge-tts")
+        entry = os.path.join("app", "server.py")
+        if os.path.isfile(os.path.join(candidate_dir, entry)):
+            return [sys.executable, entry], candidate_dir
+        return None
 
-    try:
+    def _spawn(self, backend: dict) -> None:
+        command = self._command(backend["port"])
+        if command is None:
+            logger.warning("openai-edge-tts not found; skipping TTS autostart")
+            return
+        cmd, cwd = command
         env = os.environ.copy()
-        # Ensure API key and correct port from base_url
         env.setdefault("API_KEY", env.get("TTS_API_KEY", "local"))
-        env.setdefault("PORT", base_url.rsplit(":", 1)[-1])
-        logger.info(f"Starting TTS server: {' '.join(cmd)} (PORT={env['PORT']})")
-        _tts_proc = subprocess.Popen(cmd, cwd=cwd, env=env)
-        # Wait up to ~20s for server to be ready
-        for _ in range(200):
-            if _is_tts_alive(base_url):
-                logger.info(f"TTS is up at {base_url}")
-                break
-            time.sleep(0.1)
-    except Exception:
-        _tts_proc = None
+        env["PORT"] = str(backend["port"])
+        logger.info(f"Starting TTS backend: {' '.join(cmd)} (PORT={backend['port']})")
+        try:
+            backend["proc"] = subprocess.Popen(cmd, cwd=cwd, env=env)
+        except OSError:
+            logger.exception("could not start TTS backend on port %s", backend["port"])
+            backend["proc"] = None
+            return
+        backend["managed"] = True
+        backend["healthy"] = False
+        backend["started_at"] = time.time()
+
+    def start(self) -> None:
+        """Spawn missing backends (unless autostart is disabled) and start the health prober."""
+        if self._thread is not None:
+            return
+        if _tts_autostart_enabled():
+            for backend in self.backends:
+                if backend["port"] is None:
+                    continue
+                if _is_tts_alive(backend["url"]):
+                    logger.info(f"TTS already running at {backend['url']}")
+                    continue
+                self._spawn(backend)
+            # Chờ các backend vừa chạy sẵn sàng (song song, tối đa TTS_STARTUP_TIMEOUT_SECONDS)
+            deadline = time.time() + TTS_STARTUP_TIMEOUT_SECONDS
+            pending = [b for b in self.backends if b["managed"]]
+            while pending and time.time() < deadline:
+                for backend in list(pending):
+                    if _is_tts_alive(backend["url"]):
+                        backend["healthy"] = True
+                        logger.info(f"TTS is up at {backend['url']}")
+                        pending.remove(backend)
+                if pending:
+                    time.sleep(0.1)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._probe_loop, name="tts-supervisor", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        procs = [b["proc"] for b in self.backends if b["managed"] and b["proc"] and b["proc"].poll() is None]
+        for proc in procs:
+            try:
+                proc.terminate()
+            except Exception:
+                pass
+        for proc in procs:
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            except Exception:
+                pass
+
+    def _probe_loop(self) -> None:
+        while not self._stop.wait(TTS_HEALTH_INTERVAL_SECONDS):
+            self.probe_once()
+
+    def probe_once(self) -> None:
+        for backend in self.backends:
+            proc = backend["proc"]
+            if backend["managed"] and proc is not None and proc.poll() is not None:
+                backend["healthy"] = False
+                # Tiến trình chết: chạy lại, giãn cách dần nếu chết liên tục
+                backoff = min(60.0, 2.0 ** min(backend["failures"], 6))
+                if time.time() - (backend["started_at"] or 0) >= backoff:
+                    logger.warning("TTS backend on port %s exited with %s; restarting", backend["port"], proc.returncode)
+                    backend["restarts"] += 1
+                    backend["failures"] += 1
+                    self._spawn(backend)
+                continue
+            alive = _is_tts_alive(backend["url"])
+            with self._lock:
+                backend["healthy"] = alive
+                backend["last_probe"] = time.time()
+                if alive:
+                    backend["failures"] = 0
+
+    def acquire(self, exclude: set[str] | None = None) -> dict:
+        """Backend with the fewest in-flight requests, preferring healthy ones; pair with release()."""
+        with self._lock:
+            candidates = [b for b in self.backends if b["url"] not in (exclude or ())] or self.backends
+            healthy = [b for b in candidates if b["healthy"]] or candidates
+            backend = min(healthy, key=lambda b: (b["outstanding"], b["served"]))
+            backend["outstanding"] += 1
+            return backend
+
+    def release(self, backend: dict, ok: bool) -> None:
+        with self._lock:
+            backend["outstanding"] -= 1
+            backend["served"] += 1
+            if not ok:
+                # Probe kế tiếp sẽ bật lại nếu backend vẫn sống
+                backend["healthy"] = False
+
+    def alive(self) -> bool:
+        return any(b["healthy"] for b in self.backends)
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    "url": b["url"],
+                    "healthy": b["healthy"],
+                    "managed": b["managed"],
+                    "pid": b["proc"].pid if b["proc"] and b["proc"].poll() is None else None,
+                    "outstanding": b["outstanding"],
+                    "served": b["served"],
+                    "restarts": b["restarts"],
+                    "last_probe": b["last_probe"],
+                }
+                for b in self.backends
+            ]
+
+
+# Default to 5050 per openai-edge-tts config unless TTS_BASE_URL is set
+_tts_supervisor = _TTSSupervisor(os.environ.get("TTS_BASE_URL", "http://127.0.0.1:5050"), TTS_POOL_SIZE)
 
 
 @app.on_event("startup")
 def _on_startup() -> None:
-    _ensure_tts_server_running()
+    _get_toolchain()
+    _font_registry.load()
+    _retention.start()
+    _tts_supervisor.start()
 
 
 @app.on_event("shutdown")
 def _on_shutdown() -> None:
-    global _tts_proc
-    if _tts_proc and _tts_proc.poll() is None:
-        try:
-            _tts_proc.terminate()
-        except Exception:
-            pass
+    _retention.stop()
+    _tts_supervisor.stop()
 
 @app.get("/")
 def index():
-    # Khi người dùng tải lại trang, dọn rác để tiết kiệm dung lượng
-    _cleanup_generated_files(aggressive=True)
+    # Dọn rác do _retention chạy nền; tải trang chỉ trả file tĩnh
     return FileResponse(os.path.join(STATIC_DIR, "index.html"))
 
 @app.get("/VIDEO/")
 def index_under_video():
-    _cleanup_generated_files(aggressive=True)
     return FileResponse(os.path.join(STATIC_DIR, "index.html"))
 
 @app.get("/health")
 def health():
-    tts_url = os.environ.get("TTS_BASE_URL", "http://127.0.0.1:5050")
-    alive = _is_tts_alive(tts_url)
+    # Trạng thái TTS lấy từ probe nền của supervisor, không gọi backend mỗi lần /health
     return JSONResponse({
         "web": "ok",
-        "tts_base_url": tts_url,
-        "tts_alive": alive
+        "tts_base_url": _tts_supervisor.urls[0],
+        "tts_alive": _tts_supervisor.alive(),
+        "tts_backends": _tts_supervisor.stats(),
+        "jobs": _job_queue.stats(),
+        "cost_model": _cost_model.stats(),
+        "caches": {"tts": _tts_cache.stats(), "scenes": _scene_cache.stats()},
+        "shared_inflight": {"tts": _tts_inflight.shared, "scenes": _scene_inflight.shared},
+        "toolchain": _toolchain_summary(),
+        "retention": _retention.stats(),
     })
 
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition: stage timings, encode speed, queue depth, caches, disk."""
+    lines_out: List[str] = []
+    for metric in (_stage_seconds, _job_seconds, _jobs_total, _encode_fps, _encode_speed):
+        lines_out += metric.render()
+    jobs = _job_queue.stats()
+    lines_out += [
+        "# HELP render_queue_depth Jobs waiting for a render worker.",
+        "# TYPE render_queue_depth gauge",
+        f"render_queue_depth {jobs['queued']}",
+        "# HELP render_jobs_running Jobs currently rendering.",
+        "# TYPE render_jobs_running gauge",
+        f"render_jobs_running {jobs['running']}",
+        "# HELP render_queue_estimated_seconds Predicted render seconds of all queued jobs.",
+        "# TYPE render_queue_estimated_seconds gauge",
+        f"render_queue_estimated_seconds {jobs['queued_seconds']}",
+    ]
+    lines_out += ["# HELP render_cost_scale Measured/predicted render time per encoder profile (EWMA).", "# TYPE render_cost_scale gauge"]
+    lines_out += [f"render_cost_scale{_format_labels({'profile': name})} {info['scale']}" for name, info in _cost_model.stats().items()]
+    lines_out += ["# HELP render_tts_backend_up TTS backend health from the last probe.", "# TYPE render_tts_backend_up gauge"]
+    lines_out += [f"render_tts_backend_up{_format_labels({'backend': b['url']})} {int(b['healthy'])}" for b in _tts_supervisor.stats()]
+    lines_out += ["# HELP render_tts_backend_outstanding In-flight TTS requests per backend.", "# TYPE render_tts_backend_outstanding gauge"]
+    lines_out += [f"render_tts_backend_outstanding{_format_labels({'backend': b['url']})} {b['outstanding']}" for b in _tts_supervisor.stats()]
+    # stats() quét thư mục cache: chỉ gọi một lần mỗi cache cho mỗi lần scrape
+    cache_stats = {"tts": _tts_cache.stats(), "scenes": _scene_cache.stats(), "images": _image_cache.stats()}
+    for name, help_text in (("hits", "Cache hits."), ("misses", "Cache misses."), ("evictions", "Cache evictions."), ("bytes", "Bytes stored in the cache."), ("hit_rate", "Cache hit ratio.")):
+        lines_out += [f"# HELP render_cache_{name} {help_text}", f"# TYPE render_cache_{name} {'counter' if name in ('hits', 'misses', 'evictions') else 'gauge'}"]
+        for cache_name, stats in cache_stats.items():
+            lines_out.append(f"render_cache_{name}{_format_labels({'cache': cache_name})} {stats[name]:g}")
+    retention = _retention.stats()
+    lines_out += ["# HELP render_disk_usage_bytes Bytes used per managed directory.", "# TYPE render_disk_usage_bytes gauge"]
+    for label, used in sorted(retention["usage_bytes"].items()):
+        lines_out.append(f"render_disk_usage_bytes{_format_labels({'dir': label})} {used}")
+    lines_out += [
+        "# HELP render_reclaimed_bytes_total Bytes deleted by the retention manager.",
+        "# TYPE render_reclaimed_bytes_total counter",
+        f"render_reclaimed_bytes_total {retention['reclaimed_bytes']}",
+    ]
+    return PlainTextResponse("\n".join(lines_out) + "\n", media_type="text/plain; version=0.0.4")
+
+
+@app.post("/toolchain/refresh")
+def toolchain_refresh():
+    # Gọi sau khi cài/cập nhật FFmpeg mà không cần khởi động lại server
+    _get_toolchain(refresh=True)
+    return _toolchain_summary()
+
+
+@app.get("/fonts")
+def list_fonts(refresh: bool = False):
+    """Fonts usable as font_name (file name or family), indexed from FONTS_DIR."""
+    if refresh:
+        _font_registry.load(refresh=True)
+    default = _font_registry.resolve("auto")
+    return {"fonts_dir": FONTS_DIR, "default": default["file"] if default else None, "fonts": _font_registry.listing()}
+
+
+@app.get("/VIDEO/fonts")
+def list_fonts_under_video(refresh: bool = False):
+    return list_fonts(refresh)
+
 def _color_filter_from_preset(preset: str) -> str:
     p = (preset or "").lower()
     if p == "warm":
@@ -412,79 +1972,894 @@ def _color_filter_from_preset(preset: str) -> str:
     return ""
 
 
-async def _create_video_multi_impl(request: Request, images: List[UploadFile], script: str, use_tts: bool = False, tts_voice: str = "en-US-JennyNeural", aspect: str = "16:9", color_grade: str = "", preview: bool = False, bgm: UploadFile | None = None, text_color: str = "white", font_name: str = "auto", text_effect: str = "kf_fill"):
-    # Kiểm tra FFmpeg (tìm nhiều vị trí phổ biến trên Windows)
-    ffmpeg_path = _find_ffmpeg_executable()
-    if not ffmpeg_path:
-        return {"error": "FFmpeg chưa được cài hoặc chưa có trong PATH. Hãy cài bằng winget: winget install --id FFmpeg.FFmpeg -e --source winget"}
+# ---------- Progressive HLS preview ----------
+PROGRESSIVE_PREVIEW = os.environ.get("PROGRESSIVE_PREVIEW", "1") not in ("0", "false", "FALSE")
 
-    # Kịch bản: nếu trống, tự sinh dựa trên tên file; nếu thiếu, tự bù
-    raw_lines = [l.rstrip() for l in (script or "").splitlines()]
-    lines = [l.strip() for l in raw_lines if l.strip()]
-    if not lines:
-        # Tạo kịch bản mặc định từ tên file
-        lines = []
-        for idx, img in enumerate(images, start=1):
-            name = os.path.splitext(os.path.basename(img.filename or f"ảnh_{idx}.png"))[0]
-            lines.append(name.replace("_", " ") or f"Cảnh {idx}")
-    if len(lines) < len(images):
-        # Bổ sung phần còn thiếu
-        for idx in range(len(lines)+1, len(images)+1):
-            lines.append(f"Cảnh {idx}")
-    elif len(lines) > len(images):
-        lines = lines[:len(images)]
-
-    # Lưu từng ảnh
-    img_paths = []
-    for img in images:
-        path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}_{img.filename}")
-        with open(path, "wb") as f:
-            f.write(await img.read())
-        img_paths.append(path)
-
-    clip_paths = []
-
-    # Tạo video cho từng ảnh + dòng chữ tương ứng
-    if os.name == "nt":
-        # Tìm font phổ biến trên Windows
-        possible_fonts = [
-            "C:/Windows/Fonts/arial.ttf",
-            "C:/Windows/Fonts/segoeui.ttf",
-            "C:/Windows/Fonts/tahoma.ttf",
-        ]
-        if font_name and font_name != "auto":
-            candidate = f"C:/Windows/Fonts/{font_name}"
-            font_path = candidate if os.path.isfile(candidate) else next((p for p in possible_fonts if os.path.isfile(p)), None)
-        else:
-            font_path = next((p for p in possible_fonts if os.path.isfile(p)), None)
-    else:
-        font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-    # Xác định kích thước theo tỉ lệ khung hình
+
+class _ProgressivePlaylist:
+    """HLS EVENT playlist at OUTPUT_DIR/<job_id>/index.m3u8 that grows by one MPEG-TS
+    segment per finished scene, so a preview can start playing before the concat.
+    Scenes may finish out of order; segments are always appended in scene order.
+    """
+
+    def __init__(self, ffmpeg_path: str, job_id: str) -> None:
+        self.ffmpeg_path = ffmpeg_path
+        self.directory = os.path.join(OUTPUT_DIR, job_id)
+        self.url = f"/outputs/{job_id}/index.m3u8"
+        os.makedirs(self.directory, exist_ok=True)
+        self._ready: dict[int, tuple[str, float]] = {}
+        self._segments: List[tuple[str, float]] = []
+        self._offset = 0.0
+        self._ended = False
+        self.failed = False
+
+    def scene_ready(self, index: int, clip_path: str, duration_s: float) -> int:
+        """Register a finished clip; returns how many segments were published by this call."""
+        self._ready[index] = (clip_path, duration_s)
+        published = 0
+        while not self.failed and len(self._segments) + 1 in self._ready:
+            n = len(self._segments) + 1
+            clip, seconds = self._ready.pop(n)
+            name = f"seg_{n}.ts"
+            # Remux (không encode lại); timestamp nối tiếp segment trước để player phát liền mạch
+            proc = subprocess.run([
+                self.ffmpeg_path, "-hide_banner", "-loglevel", "error",
+                "-i", clip, "-map", "0", "-c", "copy",
+                "-output_ts_offset", f"{self._offset:.3f}",
+                "-f", "mpegts", "-y", os.path.join(self.directory, name),
+            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode != 0:
+                # Không dựng được stream thì bản xem trước vẫn có MP4 khi xong
+                logger.warning("HLS segment %s failed: %s", name, proc.stderr.decode(errors="ignore"))
+                self.failed = True
+                break
+            self._segments.append((name, seconds))
+            self._offset += seconds
+            self._write()
+            published += 1
+        return published
+
+    def finish(self) -> None:
+        if self._segments:
+            self._ended = True
+            self._write()
+
+    def discard(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write(self) -> None:
+        target = max(1, math.ceil(max(seconds for _name, seconds in self._segments)))
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-PLAYLIST-TYPE:EVENT", f"#EXT-X-TARGETDURATION:{target}", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for name, seconds in self._segments:
+            lines += [f"#EXTINF:{seconds:.3f},", name]
+        if self._ended:
+            lines.append("#EXT-X-ENDLIST")
+        # Ghi file tạm rồi thay thế để player không bao giờ đọc phải playlist dở dang
+        tmp_path = os.path.join(self.directory, "index.m3u8.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, os.path.join(self.directory, "index.m3u8"))
+
+
+# ---------- Single-pass render engine ----------
+# "multipass": encode từng cảnh rồi concat (+ trộn nhạc); "single": một lệnh FFmpeg cho cả video
+RENDER_ENGINES = ("multipass", "single")
+ASPECT_RATIOS = ("16:9", "9:16", "1:1")
+# Bản xuất thêm trong cùng job (tỉ lệ khung / xem trước / hồ sơ encode): dùng chung TTS, thời gian
+# phụ đề, ảnh đã giải mã và lịch cảnh; mỗi cảnh encode mọi bản trong một tiến trình FFmpeg
+MAX_RENDITIONS = max(1, _env_int("MAX_RENDITIONS", 4))
+
+
+def _frame_size(aspect: str | None, preview: bool) -> tuple[int, int]:
+    """Output width/height for an aspect ratio (defaults to 16:9)."""
     aspect = (aspect or "16:9").strip()
     if aspect == "9:16":
-        target_w, target_h = (608, 1080) if preview else (1080, 1920)
-    elif aspect == "1:1":
-        target_w, target_h = (720, 720) if preview else (1080, 1080)
-    else:
-        target_w, target_h = (1280, 720) if preview else (1920, 1080)  # 16:9
+        return (608, 1080) if preview else (1080, 1920)
+    if aspect == "1:1":
+        return (720, 720) if preview else (1080, 1080)
+    return (1280, 720) if preview else (1920, 1080)
+
+
+def _parse_renditions(raw, aspect: str, preview: bool, encoder_profile: str | None) -> List[dict]:
+    """Extra renditions from a JSON list (objects or bare aspect strings). Fields left out
+    inherit the main render's; duplicates of the main output are dropped. Raises ValueError."""
+    if isinstance(raw, str):
+        raw = raw.strip()
+        if not raw:
+            return []
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            # Dạng rút gọn: "9:16,1:1"
+            raw = [part.strip() for part in raw.split(",") if part.strip()]
+    if raw is None:
+        return []
+    if not isinstance(raw, list):
+        raise ValueError("renditions cần là một danh sách.")
+    main = {"aspect": aspect, "preview": bool(preview), "encoder_profile": _resolve_encoder_profile(encoder_profile, preview)}
+    seen = [main]
+    out: List[dict] = []
+    for item in raw:
+        if isinstance(item, str):
+            item = {"aspect": item}
+        if not isinstance(item, dict):
+            raise ValueError("Mỗi rendition cần là object hoặc tỉ lệ khung hình.")
+        flag = item.get("preview", preview)
+        if isinstance(flag, str):
+            flag = flag.strip().lower() in ("1", "true", "yes", "on")
+        rendition = {"aspect": str(item.get("aspect") or aspect).strip(), "preview": bool(flag)}
+        if rendition["aspect"] not in ASPECT_RATIOS:
+            raise ValueError(f"Tỉ lệ khung hình không hỗ trợ: {rendition['aspect']} (chọn {', '.join(ASPECT_RATIOS)}).")
+        name = item.get("encoder_profile")
+        if name and str(name).strip().lower() not in ENCODER_PROFILES:
+            raise ValueError(f"Hồ sơ encode không tồn tại: {name}.")
+        rendition["encoder_profile"] = _resolve_encoder_profile(name if name else (encoder_profile if rendition["preview"] == bool(preview) else None), rendition["preview"])
+        if rendition not in seen:
+            seen.append(rendition)
+            out.append(rendition)
+    if len(seen) > MAX_RENDITIONS:
+        raise ValueError(f"Mỗi job tối đa {MAX_RENDITIONS} bản xuất.")
+    return out
+
+
+def _rendition_context(output: dict) -> dict:
+    """Frame size, encoder profile and codec args of one output rendition."""
+    preview = bool(output.get("preview"))
+    profile_name = _resolve_encoder_profile(output.get("encoder_profile"), preview)
+    profile = ENCODER_PROFILES[profile_name]
+    target_w, target_h = _frame_size(output.get("aspect"), preview)
+    return {
+        "aspect": (output.get("aspect") or "16:9").strip(),
+        "preview": preview,
+        "profile_name": profile_name,
+        "profile": profile,
+        "fps": profile["fps"],
+        "target_w": target_w,
+        "target_h": target_h,
+        "video_args": _video_codec_args(profile),
+    }
+
 
-    # Thời lượng mặc định mỗi ảnh
+def _rendition_summary(rend: dict, url: str) -> dict:
+    return {"aspect": rend["aspect"], "preview": rend["preview"], "encoder_profile": rend["profile_name"], "width": rend["target_w"], "height": rend["target_h"], "url": url}
+
+
+def _single_pass_cmd(ffmpeg_path: str, plans: List[dict], bgm_path: str | None, out_path: str, video_args: List[str], subtitle_filter: str | None = None) -> List[str]:
+    """One FFmpeg invocation for the whole video: every scene's zoompan/fade chain, the
+    per-scene audio concat, the video-wide subtitle track (burned after concat) and the
+    looping BGM mix in a single filter_complex graph."""
+    cmd = [ffmpeg_path, "-hide_banner", "-loglevel", "error"]
+    for plan in plans:
+        # Ảnh tĩnh chỉ đọc một frame; bước motion tự sinh đủ frame cho cảnh
+        cmd += ["-i", plan["img_path"]]
+    next_input = len(plans)
+    graph: List[str] = []
+    concat_inputs = ""
+    for i, plan in enumerate(plans):
+        # Audio mỗi cảnh được cắt/đệm đúng bằng độ dài hình để concat không lệch tiếng
+        scene_s = plan["frames"] / plan["fps"]
+        graph.append(f"[{i}:v]{plan['vf_chain']},setsar=1,format=yuv420p[v{i}]")
+        if plan["audio_path"]:
+            cmd += ["-i", plan["audio_path"]]
+            graph.append(
+                f"[{next_input}:a]aformat=sample_rates=44100:channel_layouts=stereo,"
+                f"apad,atrim=duration={scene_s:.3f},asetpts=PTS-STARTPTS[a{i}]"
+            )
+            next_input += 1
+        else:
+            graph.append(f"anullsrc=channel_layout=stereo:sample_rate=44100,atrim=duration={scene_s:.3f}[a{i}]")
+        concat_inputs += f"[v{i}][a{i}]"
+    if subtitle_filter:
+        graph.append(f"{concat_inputs}concat=n={len(plans)}:v=1:a=1[vcat][aout]")
+        graph.append(f"[vcat]{subtitle_filter}[vout]")
+    else:
+        graph.append(f"{concat_inputs}concat=n={len(plans)}:v=1:a=1[vout][aout]")
+    audio_label = "[aout]"
+    if bgm_path:
+        cmd += ["-stream_loop", "-1", "-i", bgm_path]
+        graph.append(f"[{next_input}:a]volume=0.10[music];[aout][music]amix=inputs=2:duration=first:dropout_transition=2[mix]")
+        audio_label = "[mix]"
+    cmd += [
+        "-filter_complex", ";".join(graph),
+        "-map", "[vout]", "-map", audio_label,
+        *video_args,
+        "-c:a", "aac", "-movflags", "+faststart", "-y", out_path,
+    ]
+    return cmd
+
+
+# ---------- Render cost model + admission control ----------
+# Ước lượng thời gian render (giây) của một job trước khi nhận upload:
+#   scenes * overhead + Σ_rendition rate[profile] * megapixel-frame * hệ số hiệu chỉnh
+# Hệ số hiệu chỉnh là EWMA của (thời gian đo được / ước lượng) theo từng hồ sơ encode,
+# lưu ra file để process web và các worker.py dùng chung.
+COST_MODEL_PATH = os.environ.get("COST_MODEL_PATH") or os.path.join(CACHE_DIR, "cost_model.json")
+COST_EWMA_ALPHA = 0.2
+# Giây encode cho mỗi megapixel-frame trên một lõi, trước khi có số đo thực tế
+COST_PRIOR_RATES = {"draft": 0.02, "preview": 0.025, "standard": 0.045, "archive": 0.15}
+COST_SCENE_OVERHEAD_SECONDS = 0.3
+# Ảnh đứng yên không qua zoompan nên rẻ hơn hẳn
+COST_STATIC_FACTOR = 0.5
+TTS_CHARS_PER_SECOND = 14.0
+MAX_SCENES_PER_JOB = max(1, _env_int("MAX_SCENES_PER_JOB", 300))
+MAX_JOB_RENDER_SECONDS = max(1, _env_int("MAX_JOB_RENDER_SECONDS", 1800))
+# Tổng thời gian render ước lượng của các job đang chờ/chạy mà một client được giữ cùng lúc
+CLIENT_MAX_PENDING_SECONDS = max(1, _env_int("CLIENT_MAX_PENDING_SECONDS", 3600))
+# Bản xem trước rẻ hơn ngưỡng này được ưu tiên; job chờ quá PRIORITY_AGING_SECONDS cũng được ưu tiên
+INTERACTIVE_MAX_SECONDS = max(0, _env_int("INTERACTIVE_MAX_SECONDS", 60))
+PRIORITY_AGING_SECONDS = max(1, _env_int("PRIORITY_AGING_SECONDS", 300))
+
+
+def _client_id(request: Request) -> str:
+    """Fairness key for a request: X-Client-Id when the caller sets one, else the peer address."""
+    header = (request.headers.get("x-client-id") or "").strip()
+    if header:
+        return header[:64]
+    return request.client.host if request.client else "anonymous"
+
+
+def _estimate_scene_seconds(lines: List[str], use_tts: bool, preview: bool) -> List[float]:
+    # Cùng quy tắc với _render_video: thời lượng mặc định, hoặc độ dài giọng đọc dự đoán theo số ký tự
     default_duration = 3.0 if preview else 5.0
-    fade_dur = 0.6 if default_duration >= 1.2 else max(0.2, default_duration / 4)
-    color_filter = _color_filter_from_preset(color_grade)
+    if not use_tts:
+        return [default_duration] * len(lines)
+    return [max(1.0, len(line) / TTS_CHARS_PER_SECOND) for line in lines]
 
-    # Nếu có nhạc nền, lưu tạm (sẽ trộn sau khi nối video để nhạc chạy liền mạch)
-    bgm_path: str | None = None
-    if bgm is not None:
+
+class _CostModel:
+    """Predicts render seconds for a job spec and learns a per-profile correction from
+    finished jobs. Shared between processes through a small JSON file."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._scale: dict[str, float] = {}
+        self._samples: dict[str, int] = {}
+        self._mtime = 0.0
+        self._reload()
+
+    def _reload(self) -> None:
         try:
-            bgm_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}_{bgm.filename or 'bgm.mp3'}")
-            with open(bgm_path, "wb") as f:
-                f.write(await bgm.read())
-        except Exception:
-            bgm_path = None
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._scale = {k: float(v) for k, v in (data.get("scale") or {}).items()}
+            self._samples = {k: int(v) for k, v in (data.get("samples") or {}).items()}
+        except (OSError, ValueError, AttributeError):
+            logger.warning("ignoring unreadable cost model at %s", self.path)
+        self._mtime = mtime
+
+    def _save(self) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"scale": self._scale, "samples": self._samples}, f)
+            os.replace(tmp, self.path)
+            self._mtime = os.stat(self.path).st_mtime
+        except OSError:
+            logger.warning("could not persist cost model to %s", self.path)
+
+    @staticmethod
+    def _prior_seconds(spec: dict) -> tuple[str, float]:
+        """(main profile name, uncalibrated seconds) for a spec or spec-shaped options dict."""
+        preview = bool(spec.get("preview"))
+        scene_seconds = _estimate_scene_seconds(spec.get("lines") or [], bool(spec.get("use_tts")), preview)
+        motion_factor = COST_STATIC_FACTOR if spec.get("motion") == "none" else 1.0
+        outputs = [{"aspect": spec.get("aspect"), "preview": preview, "encoder_profile": spec.get("encoder_profile")}]
+        outputs += spec.get("renditions") or []
+        main_profile = None
+        seconds = COST_SCENE_OVERHEAD_SECONDS * len(scene_seconds)
+        for output in outputs:
+            profile_name = _resolve_encoder_profile(output.get("encoder_profile"), bool(output.get("preview")))
+            main_profile = main_profile or profile_name
+            width, height = _frame_size(output.get("aspect"), bool(output.get("preview")))
+            mpx_frames = sum(scene_seconds) * ENCODER_PROFILES[profile_name]["fps"] * width * height / 1e6
+            seconds += COST_PRIOR_RATES.get(profile_name, COST_PRIOR_RATES["standard"]) * mpx_frames * motion_factor
+        return main_profile, seconds
+
+    def estimate(self, spec: dict) -> float:
+        """Predicted wall-clock render seconds of one job on one render slot."""
+        profile_name, prior = self._prior_seconds(spec)
+        with self._lock:
+            self._reload()
+            scale = self._scale.get(profile_name, 1.0)
+        return round(prior * scale, 1)
+
+    def observe(self, spec: dict, seconds: float) -> None:
+        """Fold the measured render time of a finished job into its profile's correction."""
+        profile_name, prior = self._prior_seconds(spec)
+        if prior <= 0 or seconds <= 0:
+            return
+        # Kẹp tỉ lệ để một job bất thường (đĩa chậm, máy bận) không kéo lệch cả mô hình
+        ratio = min(20.0, max(0.05, seconds / prior))
+        with self._lock:
+            self._reload()
+            old = self._scale.get(profile_name)
+            self._scale[profile_name] = ratio if old is None else old + COST_EWMA_ALPHA * (ratio - old)
+            self._samples[profile_name] = self._samples.get(profile_name, 0) + 1
+            self._save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._reload()
+            return {name: {"scale": round(self._scale[name], 3), "samples": self._samples.get(name, 0)} for name in sorted(self._scale)}
+
+
+_cost_model = _CostModel(COST_MODEL_PATH)
+
+
+# ---------- Render job queue ----------
+RENDER_JOB_CONCURRENCY = max(1, _env_int("RENDER_JOB_CONCURRENCY", 2))
+RENDER_QUEUE_LIMIT = max(1, _env_int("RENDER_QUEUE_LIMIT", 16))
+# Job của batch được đếm riêng: hàng đợi batch dài không chiếm chỗ của job gửi trực tiếp
+BATCH_QUEUE_LIMIT = max(1, _env_int("BATCH_QUEUE_LIMIT", 400))
+JOB_RETENTION_SECONDS = _env_int("JOB_RETENTION_SECONDS", 3600)
+# "memory": worker thread trong chính process web (mặc định)
+# "sqlite": web chỉ xếp job vào DB, các process `python worker.py` nhận job theo lease
+RENDER_QUEUE_BACKEND = (os.environ.get("RENDER_QUEUE_BACKEND") or "memory").strip().lower()
+RENDER_QUEUE_DB = os.environ.get("RENDER_QUEUE_DB") or os.path.join(BASE_DIR, "render_queue.sqlite3")
+RENDER_LEASE_SECONDS = max(10, _env_int("RENDER_LEASE_SECONDS", 60))
+RENDER_MAX_ATTEMPTS = max(1, _env_int("RENDER_MAX_ATTEMPTS", 3))
+
+
+def _set_job_progress(job: dict | None, value: float) -> None:
+    if job is not None:
+        job["progress"] = round(min(1.0, max(0.0, value)), 3)
+
+
+def _execute_job(job: dict) -> dict:
+    """Render one dequeued job and record its queue spans, metrics and log line.
+    Returns the `_render_video` result; unexpected crashes come back as an error
+    with "retry": True, and a render stopped through job["cancel"] with "cancelled":
+    True (its outputs already removed). Workspace cleanup is left to the caller.
+    """
+    if job["spec"].get("upload_seconds") is not None:
+        _record_span(job, "upload", job["spec"]["upload_seconds"])
+    _record_span(job, "queue_wait", job["started_at"] - job["created_at"])
+    try:
+        result = _render_video(job["spec"], job)
+    except Exception as exc:
+        logger.exception("render job %s crashed", job["id"])
+        result = {"error": f"Lỗi không mong muốn khi tạo video: {exc}", "retry": True}
+    if job.get("cancel") is not None and job["cancel"].is_set():
+        # Job đã sang worker khác: không tính lần chạy dở này vào metrics hay mô hình chi phí
+        _remove_outputs(result.get("renditions") or [])
+        logger.info(json.dumps({"job": job["id"], "cancelled": True, "spans": job.get("spans", [])}))
+        return {"error": JOB_CANCELLED_ERROR, "cancelled": True}
+    if result.get("url"):
+        # Chỉ hiệu chỉnh mô hình chi phí bằng job tự encode mọi cảnh; cảnh lấy từ cache làm job nhanh bất thường
+        encoded = {s.get("scene") for s in job.get("spans", []) if s["stage"] == "encode"}
+        if job["spec"].get("engine") == "single" or len(encoded) >= len(job["spec"].get("lines") or []):
+            _cost_model.observe(job["spec"], time.time() - job["started_at"])
+    _job_seconds.observe(time.time() - job["started_at"])
+    _jobs_total.inc(status="done" if result.get("url") else "failed")
+    logger.info(json.dumps({"job": job["id"], "ok": bool(result.get("url")), "spans": job.get("spans", [])}))
+    return result
+
+
+def _job_lane(job: dict, now: float) -> int:
+    """0 = served first: cheap interactive previews, or any job waiting PRIORITY_AGING_SECONDS."""
+    return 0 if job.get("interactive") or now - job["created_at"] >= PRIORITY_AGING_SECONDS else 1
+
+
+def _dispatch_order(queued: List[dict], running: List[dict], last_served: dict[str, float], now: float) -> List[dict]:
+    """Queued jobs in the order render slots will take them. Each pick goes to the lowest
+    lane, then the client with the fewest jobs in flight, then the client served least
+    recently (round-robin), then FIFO, so a client's big batch interleaves with other
+    clients' work instead of running ahead of it."""
+    per_client: dict[str, deque] = {}
+    for job in sorted(queued, key=lambda j: (_job_lane(j, now), j["created_at"])):
+        per_client.setdefault(job.get("client") or "", deque()).append(job)
+    in_flight: dict[str, int] = {}
+    for job in running:
+        client = job.get("client") or ""
+        in_flight[client] = in_flight.get(client, 0) + 1
+    served = dict(last_served)
+    order: List[dict] = []
+    while per_client:
+        client = min(per_client, key=lambda c: (_job_lane(per_client[c][0], now), in_flight.get(c, 0), served.get(c, 0.0), per_client[c][0]["created_at"]))
+        order.append(per_client[client].popleft())
+        if not per_client[client]:
+            del per_client[client]
+        in_flight[client] = in_flight.get(client, 0) + 1
+        served[client] = now + len(order)
+    return order
+
+
+def _eta_seconds(order: List[dict], running: List[dict], slots: int) -> dict[str, float]:
+    """Predicted seconds until each running/queued job finishes, from the cost estimates and
+    `slots` parallel render slots working through `order`."""
+    eta: dict[str, float] = {}
+    free: List[float] = []
+    for job in running:
+        remaining = max(0.0, (job.get("estimate") or 0.0) * (1.0 - (job.get("progress") or 0.0)))
+        eta[job["id"]] = round(remaining, 1)
+        free.append(remaining)
+    free += [0.0] * max(0, max(1, slots) - len(free))
+    heapq.heapify(free)
+    for job in order:
+        finish = heapq.heappop(free) + (job.get("estimate") or 0.0)
+        eta[job["id"]] = round(finish, 1)
+        heapq.heappush(free, finish)
+    return eta
+
+
+class _JobQueue:
+    """In-process render queue: a fixed number of worker threads run `_render_video`
+    on queued jobs (picked by `_dispatch_order`), keeping the event loop free."""
+
+    def __init__(self, concurrency: int, limit: int, batch_limit: int) -> None:
+        self.concurrency = concurrency
+        self.limit = limit
+        self.batch_limit = batch_limit
+        self._jobs: dict[str, dict] = {}
+        self._pending: deque[str] = deque()
+        self._last_served: dict[str, float] = {}
+        self._batches: dict[str, dict] = {}
+        self._cond = threading.Condition()
+        self._workers: List[threading.Thread] = []
+
+    def submit(self, spec: dict, base_prefix: str = "", job_id: str | None = None, client: str = "", estimate: float = 0.0, batch: bool = False) -> dict | None:
+        """Queue a render; returns None when its admission limit is reached (self.limit for
+        direct jobs, self.batch_limit for batch jobs, each counting only its own kind)."""
+        with self._cond:
+            self._prune_locked()
+            if self._queued_locked(batch) >= (self.batch_limit if batch else self.limit):
+                return None
+            job = {
+                "id": job_id or uuid.uuid4().hex,
+                "status": "queued",
+                "progress": 0.0,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "url": None,
+                "renditions": None,
+                "playlist_url": None,
+                "error": None,
+                "base_prefix": base_prefix,
+                "client": client,
+                "estimate": estimate,
+                "interactive": bool(spec.get("preview")) and estimate <= INTERACTIVE_MAX_SECONDS,
+                "batch": batch,
+                "spec": spec,
+            }
+            self._jobs[job["id"]] = job
+            self._pending.append(job["id"])
+            while len(self._workers) < self.concurrency:
+                worker = threading.Thread(target=self._worker, name=f"render-job-{len(self._workers)}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+            self._cond.notify()
+            return job
+
+    def snapshot(self, job_id: str) -> dict | None:
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            position, eta = 0, None
+            if job["status"] in ("queued", "running"):
+                running = self._running_locked()
+                order = self._order_locked(running)
+                position = next((n for n, j in enumerate(order, start=1) if j is job), 0)
+                eta = _eta_seconds(order[:position], running, self.concurrency).get(job_id)
+            return {
+                "job_id": job_id,
+                "status": job["status"],
+                "progress": job["progress"],
+                "queue_position": position,
+                "estimated_seconds": job["estimate"],
+                "eta_seconds": eta,
+                "status_url": f"{job['base_prefix']}/jobs/{job_id}",
+                "url": job["url"],
+                "renditions": job["renditions"],
+                "playlist_url": job["playlist_url"],
+                "error": job["error"],
+                "spans": list(job.get("spans", [])),
+            }
+
+    def stats(self) -> dict:
+        with self._cond:
+            running = self._running_locked()
+            queued_seconds = sum(self._jobs[i]["estimate"] for i in self._pending)
+            clients = {j["client"] for j in running} | {self._jobs[i]["client"] for i in self._pending}
+            return {
+                "backend": "memory", "queued": len(self._pending), "queued_batch": self._queued_locked(True), "running": len(running),
+                "concurrency": self.concurrency, "limit": self.limit, "batch_limit": self.batch_limit,
+                "queued_seconds": round(queued_seconds, 1), "clients": len(clients),
+            }
+
+    def queued_jobs(self, batch: bool, client: str | None = None) -> int:
+        """Queued jobs of one kind (batch or direct), optionally only those of client."""
+        with self._cond:
+            return self._queued_locked(batch, client)
+
+    def _queued_locked(self, batch: bool, client: str | None = None) -> int:
+        return sum(1 for i in self._pending if self._jobs[i]["batch"] == batch and (client is None or self._jobs[i]["client"] == client))
+
+    def outstanding(self, client: str) -> float:
+        """Predicted render seconds still owed to client (queued jobs + rest of running ones)."""
+        with self._cond:
+            return sum(
+                j["estimate"] * (1.0 - j["progress"]) if j["status"] == "running" else j["estimate"]
+                for j in self._jobs.values() if j["client"] == client and j["status"] in ("queued", "running")
+            )
+
+    def _running_locked(self) -> List[dict]:
+        return [j for j in self._jobs.values() if j["status"] == "running"]
+
+    def _order_locked(self, running: List[dict]) -> List[dict]:
+        return _dispatch_order([self._jobs[i] for i in self._pending], running, self._last_served, time.time())
+
+    def finished(self, job_id: str) -> bool:
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return job is not None and job["status"] in ("done", "failed")
+
+    def save_batch(self, batch: dict) -> None:
+        """Remember which jobs make up a batch (kept while any of its jobs is still known)."""
+        with self._cond:
+            self._prune_locked()
+            self._batches[batch["id"]] = batch
+
+    def load_batch(self, batch_id: str) -> dict | None:
+        with self._cond:
+            return self._batches.get(batch_id)
+
+    def _prune_locked(self) -> None:
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [k for k, j in self._jobs.items() if j["finished_at"] and j["finished_at"] < cutoff]:
+            del self._jobs[job_id]
+        for batch_id in [k for k, b in self._batches.items() if b["created_at"] < cutoff and not any(v["job_id"] in self._jobs for v in b["videos"])]:
+            del self._batches[batch_id]
+        active = {j["client"] for j in self._jobs.values()}
+        for client in [c for c in self._last_served if c not in active]:
+            del self._last_served[client]
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = self._order_locked(self._running_locked())[0]
+                self._pending.remove(job["id"])
+                job["status"] = "running"
+                job["started_at"] = time.time()
+                self._last_served[job["client"]] = job["started_at"]
+            try:
+                result = _execute_job(job)
+            finally:
+                _remove_job_workspace(job["spec"].get("workspace"))
+                _retention.release(job["id"])
+            with self._cond:
+                job["finished_at"] = time.time()
+                if result.get("url"):
+                    job["status"] = "done"
+                    job["url"] = f"{job['base_prefix']}{result['url']}"
+                    job["renditions"] = [dict(r, url=f"{job['base_prefix']}{r['url']}") for r in result.get("renditions") or []]
+                    job["progress"] = 1.0
+                else:
+                    job["status"] = "failed"
+                    job["error"] = result.get("error") or "Có lỗi xảy ra!"
+
+
+class _SqliteJobQueue:
+    """Durable render queue in a local SQLite file shared by the web process and any
+    number of `worker.py` processes on the same host. The web tier only inserts and
+    reads jobs; workers lease one job at a time, heartbeat to extend the lease, and a
+    lease that expires (worker crashed or was killed) puts the job back in the queue
+    until RENDER_MAX_ATTEMPTS is reached.
+    """
+
+    def __init__(self, path: str, limit: int, batch_limit: int) -> None:
+        self.path = path
+        self.limit = limit
+        self.batch_limit = batch_limit
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL, spec TEXT NOT NULL, base_prefix TEXT NOT NULL,"
+                " progress REAL NOT NULL DEFAULT 0, url TEXT, renditions TEXT, playlist_url TEXT, error TEXT, spans TEXT,"
+                " client TEXT NOT NULL DEFAULT '', estimate REAL NOT NULL DEFAULT 0, interactive INTEGER NOT NULL DEFAULT 0, batch INTEGER NOT NULL DEFAULT 0,"
+                " attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, lease_until REAL,"
+                " created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            db.execute("CREATE TABLE IF NOT EXISTS batches (id TEXT PRIMARY KEY, base_prefix TEXT NOT NULL, videos TEXT NOT NULL, created_at REAL NOT NULL)")
+            # DB tạo bởi phiên bản cũ hơn: bổ sung các cột mới
+            for column in ("renditions TEXT", "client TEXT NOT NULL DEFAULT ''", "estimate REAL NOT NULL DEFAULT 0", "interactive INTEGER NOT NULL DEFAULT 0", "batch INTEGER NOT NULL DEFAULT 0"):
+                try:
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    pass
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def submit(self, spec: dict, base_prefix: str = "", job_id: str | None = None, client: str = "", estimate: float = 0.0, batch: bool = False) -> dict | None:
+        """Queue a render; returns None when its admission limit is reached (self.limit for
+        direct jobs, self.batch_limit for batch jobs, each counting only its own kind)."""
+        job_id = job_id or uuid.uuid4().hex
+        interactive = bool(spec.get("preview")) and estimate <= INTERACTIVE_MAX_SECONDS
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (now - JOB_RETENTION_SECONDS,))
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND batch = ?", (int(batch),)).fetchone()[0]
+            if queued >= (self.batch_limit if batch else self.limit):
+                db.execute("ROLLBACK")
+                return None
+            db.execute(
+                "INSERT INTO jobs (id, status, spec, base_prefix, client, estimate, interactive, batch, created_at) VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(spec), base_prefix, client, estimate, int(interactive), int(batch), now),
+            )
+            db.execute("COMMIT")
+        return {"id": job_id, "status": "queued", "spec": spec, "base_prefix": base_prefix, "client": client, "estimate": estimate, "created_at": now}
+
+    @staticmethod
+    def _plan(db, now: float) -> tuple[List[dict], List[dict]]:
+        """(dispatch order of queued jobs, running jobs) from the table, for `lease` and ETAs."""
+        cols = "id, client, estimate, interactive, progress, created_at"
+        queued = [dict(r) for r in db.execute(f"SELECT {cols} FROM jobs WHERE status = 'queued'").fetchall()]
+        running = [dict(r) for r in db.execute(f"SELECT {cols} FROM jobs WHERE status = 'running'").fetchall()]
+        last_served = dict(db.execute("SELECT client, MAX(started_at) FROM jobs WHERE started_at IS NOT NULL GROUP BY client").fetchall())
+        return _dispatch_order(queued, running, last_served, now), running
+
+    def snapshot(self, job_id: str) -> dict | None:
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            position, eta = 0, None
+            if row["status"] in ("queued", "running"):
+                order, running = self._plan(db, time.time())
+                position = next((n for n, j in enumerate(order, start=1) if j["id"] == job_id), 0)
+                # Số worker không cố định: coi mỗi job đang chạy là một slot
+                eta = _eta_seconds(order[:position], running, max(1, len(running))).get(job_id)
+        return {
+            "job_id": job_id,
+            "status": row["status"],
+            "progress": row["progress"],
+            "queue_position": position,
+            "estimated_seconds": row["estimate"],
+            "eta_seconds": eta,
+            "status_url": f"{row['base_prefix']}/jobs/{job_id}",
+            "url": row["url"],
+            "renditions": json.loads(row["renditions"]) if row["renditions"] else None,
+            "playlist_url": row["playlist_url"],
+            "error": row["error"],
+            "spans": json.loads(row["spans"] or "[]"),
+        }
+
+    def stats(self) -> dict:
+        with self._connect() as db:
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status").fetchall())
+            queued_batch = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND batch = 1").fetchone()[0]
+            workers = db.execute("SELECT COUNT(DISTINCT worker) FROM jobs WHERE status = 'running' AND lease_until >= ?", (time.time(),)).fetchone()[0]
+            queued_seconds, clients = db.execute(
+                "SELECT COALESCE(SUM(CASE WHEN status = 'queued' THEN estimate END), 0), COUNT(DISTINCT client) FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchone()
+        return {
+            "backend": "sqlite", "queued": counts.get("queued", 0), "queued_batch": queued_batch, "running": counts.get("running", 0),
+            "busy_workers": workers, "limit": self.limit, "batch_limit": self.batch_limit,
+            "queued_seconds": round(queued_seconds, 1), "clients": clients,
+        }
+
+    def queued_jobs(self, batch: bool, client: str | None = None) -> int:
+        """Queued jobs of one kind (batch or direct), optionally only those of client."""
+        with self._connect() as db:
+            if client is None:
+                return db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND batch = ?", (int(batch),)).fetchone()[0]
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND batch = ? AND client = ?", (int(batch), client)).fetchone()[0]
+
+    def outstanding(self, client: str) -> float:
+        """Predicted render seconds still owed to client (queued jobs + rest of running ones)."""
+        with self._connect() as db:
+            return db.execute(
+                "SELECT COALESCE(SUM(CASE WHEN status = 'running' THEN estimate * (1 - progress) ELSE estimate END), 0) "
+                "FROM jobs WHERE client = ? AND status IN ('queued', 'running')",
+                (client,),
+            ).fetchone()[0]
+
+    def finished(self, job_id: str) -> bool:
+        with self._connect() as db:
+            row = db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is not None and row["status"] in ("done", "failed")
+
+    def save_batch(self, batch: dict) -> None:
+        """Remember which jobs make up a batch (kept while any of its jobs is still in the table)."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "DELETE FROM batches WHERE created_at < ? AND NOT EXISTS ("
+                " SELECT 1 FROM json_each(batches.videos) AS v JOIN jobs ON jobs.id = json_extract(v.value, '$.job_id'))",
+                (time.time() - JOB_RETENTION_SECONDS,),
+            )
+            db.execute(
+                "INSERT INTO batches (id, base_prefix, videos, created_at) VALUES (?, ?, ?, ?)",
+                (batch["id"], batch["base_prefix"], json.dumps(batch["videos"]), batch["created_at"]),
+            )
+            db.execute("COMMIT")
+
+    def load_batch(self, batch_id: str) -> dict | None:
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        if row is None:
+            return None
+        return {"id": row["id"], "created_at": row["created_at"], "base_prefix": row["base_prefix"], "videos": json.loads(row["videos"])}
+
+    # --- worker side ---
+    def lease(self, worker_id: str) -> dict | None:
+        """Claim the next queued job (see `_dispatch_order`) for worker_id, recovering expired leases first."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            # Lease hết hạn = worker chết giữa chừng: trả job về hàng đợi, hoặc đánh lỗi khi đã thử đủ số lần
+            db.execute(
+                "UPDATE jobs SET status = 'failed', worker = NULL, finished_at = ?, error = ? "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, "Render worker dừng đột ngột quá nhiều lần.", now, RENDER_MAX_ATTEMPTS),
+            )
+            db.execute("UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND lease_until < ?", (now,))
+            order, _running = self._plan(db, now)
+            if not order:
+                db.execute("COMMIT")
+                return None
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (order[0]["id"],)).fetchone()
+            db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, started_at = ? WHERE id = ?",
+                (worker_id, now + RENDER_LEASE_SECONDS, now, row["id"]),
+            )
+            db.execute("COMMIT")
+        return {
+            "id": row["id"],
+            "status": "running",
+            "spec": json.loads(row["spec"]),
+            "base_prefix": row["base_prefix"],
+            "client": row["client"],
+            "estimate": row["estimate"],
+            "progress": 0.0,
+            "playlist_url": None,
+            "attempt": row["attempts"] + 1,
+            "created_at": row["created_at"],
+            "started_at": now,
+        }
+
+    def heartbeat(self, job: dict, worker_id: str) -> bool:
+        """Extend the lease and publish progress; False if the lease was lost to another worker."""
+        with self._connect() as db:
+            cur = db.execute(
+                "UPDATE jobs SET lease_until = ?, progress = ?, playlist_url = ?, spans = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + RENDER_LEASE_SECONDS, job.get("progress", 0.0), job.get("playlist_url"), json.dumps(job.get("spans", [])), job["id"], worker_id),
+            )
+            return cur.rowcount == 1
+
+    def complete(self, job: dict, worker_id: str, result: dict) -> bool:
+        """Record the result; False if worker_id no longer holds the job (lease lost), in
+        which case nothing was written and the caller must not clean up or publish."""
+        url = f"{job['base_prefix']}{result['url']}" if result.get("url") else None
+        renditions = [dict(r, url=f"{job['base_prefix']}{r['url']}") for r in result.get("renditions") or []] if url else None
+        with self._connect() as db:
+            cur = db.execute(
+                "UPDATE jobs SET status = ?, url = ?, renditions = ?, error = ?, progress = ?, playlist_url = ?, spans = ?, worker = NULL, finished_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                ("done" if url else "failed", url, json.dumps(renditions) if renditions else None, None if url else (result.get("error") or "Có lỗi xảy ra!"),
+                 1.0 if url else job.get("progress", 0.0), job.get("playlist_url"), json.dumps(job.get("spans", [])), time.time(), job["id"], worker_id),
+            )
+            return cur.rowcount == 1
+
+    def retry(self, job: dict, worker_id: str) -> bool:
+        """Give a crashed attempt back to the queue (inputs stay in the workspace); False if the lease was lost."""
+        with self._connect() as db:
+            cur = db.execute("UPDATE jobs SET status = 'queued', worker = NULL, progress = 0 WHERE id = ? AND worker = ? AND status = 'running'", (job["id"], worker_id))
+            return cur.rowcount == 1
+
+
+_job_queue = (
+    _SqliteJobQueue(RENDER_QUEUE_DB, RENDER_QUEUE_LIMIT, BATCH_QUEUE_LIMIT)
+    if RENDER_QUEUE_BACKEND == "sqlite"
+    else _JobQueue(RENDER_JOB_CONCURRENCY, RENDER_QUEUE_LIMIT, BATCH_QUEUE_LIMIT)
+)
+
 
-    for i, (img_path, text) in enumerate(zip(img_paths, lines), start=1):
-        out_clip = os.path.join(OUTPUT_DIR, f"clip_{i}.mp4")
+def _render_video(spec: dict, job: dict | None = None) -> dict:
+    """Render a queued job spec (saved uploads + options) into published MP4s.
+    Runs on a background job worker; returns {"url": ..., "renditions": [...]} or {"error": ...}.
+    The first rendition is the main output; extra ones reuse its TTS, caption timing,
+    decoded images and scene schedule.
+    """
+    ffmpeg_path = _get_toolchain()["ffmpeg"]
+    if not ffmpeg_path:
+        return {"error": "FFmpeg chưa được cài hoặc chưa có trong PATH. Hãy cài bằng winget: winget install --id FFmpeg.FFmpeg -e --source winget"}
+    img_paths: List[str] = spec["img_paths"]
+    lines: List[str] = spec["lines"]
+    use_tts = spec["use_tts"]
+    tts_voice = spec["tts_voice"]
+    aspect = spec["aspect"]
+    color_grade = spec["color_grade"]
+    preview = spec["preview"]
+    bgm_path: str | None = spec["bgm_path"]
+    text_color = spec["text_color"]
+    font_name = spec["font_name"]
+    text_effect = spec["text_effect"]
+    motion = spec.get("motion") or DEFAULT_MOTION
+    motion_ease = spec.get("motion_ease") or DEFAULT_MOTION_EASE
+    engine = spec.get("engine", "multipass")
+    rends = [_rendition_context({"aspect": aspect, "preview": preview, "encoder_profile": spec.get("encoder_profile")})]
+    rends += [_rendition_context(r) for r in spec.get("renditions") or []]
+    if len(rends) > 1:
+        # Các bản xuất tách nhánh trong lệnh encode từng cảnh => chỉ multipass
+        engine = "multipass"
+    target_w, target_h = rends[0]["target_w"], rends[0]["target_h"]
+    job_id = job["id"] if job else None
+    # Worker đặt cờ này khi mất lease: job đã thuộc về worker khác, dừng render ngay
+    cancel: threading.Event | None = job.get("cancel") if job else None
+    workspace: str = spec["workspace"]
+    n_scenes = max(1, len(img_paths))
+
+    # Theo từng rendition: đường dẫn clip, độ dài clip và vị trí nhạc nền của mỗi cảnh
+    clip_paths: List[List[str]] = [[] for _ in rends]
+    clip_seconds: List[dict[int, float]] = [{} for _ in rends]
+    bgm_offsets: List[dict[int, float]] = [{} for _ in rends]
+    scene_cmds: List[List[str] | Future | None] = []
+    scene_keys: dict[int, dict[int, str]] = {}
+    owned_keys: set[str] = set()
+    # Cảnh chuẩn bị trên luồng TTS nhận khoá song song với luồng chính; sau khi job dừng thì không nhận nữa
+    keys_lock = threading.Lock()
+    aborted = False
+    img_hashes = spec.get("img_hashes") or [_file_sha256(p) for p in img_paths]
+
+    # Font lạ đã được đổi về mặc định lúc nhận job; font bị gỡ sau đó thì cũng quay về mặc định
+    font = _font_registry.resolve(font_name) or _font_registry.resolve("auto")
+    font_path = font["path"] if font else None
+    font_family = font["family"] if font else None
+    fonts_dir = _font_registry.fontsdir(font) if font else None
+
+    # Thời lượng mặc định mỗi ảnh (theo bản chính; các bản thêm dùng chung lịch cảnh)
+    default_duration = 3.0 if preview else 5.0
+    fade_dur = 0.6 if default_duration >= 1.2 else max(0.2, default_duration / 4)
+    color_filter = _color_filter_from_preset(color_grade)
+    # Độ dài nhạc nền để quy offset mỗi cảnh về trong một vòng lặp (multipass trộn nhạc theo cảnh)
+    bgm_seconds = _audio_duration_seconds(bgm_path) if bgm_path and engine != "single" else None
+    # Chọn codec/filter theo những gì FFmpeg đang cài thực sự hỗ trợ
+    video_args = rends[0]["video_args"]
+    use_ass = _toolchain_has_filter("subtitles")
+    use_zoompan = _toolchain_has_filter("zoompan")
+
+    # Giải mã + thu nhỏ ảnh nguồn một lần (song song) cho mọi kích thước khung cần dùng
+    frame_sizes = list(dict.fromkeys((r["target_w"], r["target_h"]) for r in rends))
+
+    def _normalize_scene_image(i: int) -> dict[tuple[int, int], str | None]:
+        with _job_span(job, "normalize", i):
+            return _normalize_image(ffmpeg_path, img_paths[i - 1], img_hashes[i - 1], frame_sizes, workspace)
+
+    frame_paths: List[dict[tuple[int, int], str | None]] = list(_scene_pool.map(_normalize_scene_image, range(1, len(img_paths) + 1)))
+
+    def _plan_scene(i: int, img_path: str, text: str, tts: tuple[str, float | None] | None, burn_ass: bool = True, r: int = 0) -> dict:
+        """Filter chain, duration and audio source of scene i in rendition r, shared by both
+        render engines. With burn_ass=False the ASS captions are left out of the chain (added
+        once after concat); otherwise vf_chain stays None until `_burn_scene_ass` writes the
+        scene's ASS file, which is only done once the scene cache has missed."""
+        rend = rends[r]
+        target_w, target_h, fps = rend["target_w"], rend["target_h"], rend["fps"]
+        frame_path = frame_paths[i - 1].get((target_w, target_h))
+        normalized = frame_path is not None
+        if normalized:
+            img_path = frame_path
         safe_text = text.replace("'", r"\'")
         if font_path:
             font_escaped = _escape_path_for_drawtext(font_path)
@@ -508,124 +2883,836 @@ async def _create_video_multi_impl(request: Request, images: List[UploadFile], s
             f"scale=w={target_w}:h={target_h}:force_original_aspect_ratio=decrease,"
             f"pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2:color=black"
         )
-        # Zoom nhẹ (Ken Burns) và fade mượt
-        # Số frame theo fps 30
+        # Ken Burns theo motion/easing đã chọn và fade mượt; số frame theo fps của hồ sơ encode
         duration_s = default_duration
         audio_path = None
-        if use_tts and text:
-            audio_path = _synthesize_tts_mp3(text, tts_voice)
-            if not audio_path:
-                return {"error": f"TTS không hoạt động. Kiểm tra server TTS tại {os.environ.get('TTS_BASE_URL', 'http://127.0.0.1:5000')}/v1/audio/speech hoặc đặt TTS_BASE_URL cho đúng."}
-            # Build karaoke ASS and overlay via subtitles; rely on -shortest to match audio
-            duration_s = _ffprobe_duration_seconds(audio_path) or default_duration
-            ass_path = _write_karaoke_ass(text, duration_s, target_w, target_h, font_path, text_color, text_effect)
-            ass_escaped = _escape_path_for_drawtext(ass_path)
-            frames = max(1, int(duration_s * 30))
-            zoom = f"zoompan=z='min(zoom+0.0015,1.06)':d={frames}:s={target_w}x{target_h}:fps=30"
-            fades = f"fade=t=in:st=0:d={fade_dur},fade=t=out:st={max(0.0, duration_s-fade_dur)}:d={fade_dur}"
-            parts = [scale_filter]
-            if color_filter:
-                parts.append(color_filter)
-            parts.append(zoom)
-            parts.append(f"subtitles='{ass_escaped}'")
-            parts.append(fades)
-            vf_chain = ",".join(parts)
-            cmd = [
-                ffmpeg_path, "-hide_banner", "-loglevel", "error",
-                "-loop", "1", "-i", img_path,
-                "-i", audio_path,
-                "-vf", vf_chain,
-                "-map", "0:v", "-map", "1:a",
-                "-c:v", "libx264", "-pix_fmt", "yuv420p",
-                "-c:a", "aac", "-shortest", "-y", out_clip
-            ]
+        if tts:
+            # Karaoke ASS theo độ dài giọng đọc; clip dài đúng bằng audio
+            audio_path, measured = tts
+            duration_s = measured or default_duration
+        frames = max(1, int(duration_s * fps))
+        zoom = _motion_filter(motion, motion_ease, frames, fps, target_w, target_h, use_zoompan)
+        fades = f"fade=t=in:st=0:d={fade_dur},fade=t=out:st={max(0.0, duration_s-fade_dur)}:d={fade_dur}"
+        # Ảnh đã chuẩn hoá đúng tỉ lệ khung nên không cần scale/pad nữa; zoompan tự thu về s=
+        parts = [] if normalized else [scale_filter]
+        if color_filter:
+            parts.append(color_filter)
+        parts.append(zoom)
+        parts.append("setsar=1")
+        # Use ASS even without TTS so text animates per selected effect
+        pending_ass = use_ass and burn_ass
+        if use_ass:
+            text_filter = "ass"
+        else:
+            # FFmpeg không có libass: chữ tĩnh bằng drawtext
+            text_filter = filter_str
+            parts.append(text_filter)
+        return {
+            "img_path": img_path,
+            "text": text,
+            "audio_path": audio_path,
+            "duration_s": duration_s,
+            "frames": frames,
+            "fps": fps,
+            "zoom": zoom,
+            "normalized": normalized,
+            "text_filter": text_filter,
+            "r": r,
+            "pre_ass": parts if pending_ass else None,
+            "fades": fades,
+            "vf_chain": None if pending_ass else ",".join([*parts, fades]),
+        }
+
+    def _burn_scene_ass(i: int, plan: dict) -> None:
+        """Write scene i's karaoke ASS for plan's rendition and complete its filter chain."""
+        if plan["pre_ass"] is None:
+            return
+        r = plan["r"]
+        with _job_span(job, "ass", i):
+            ass_name = f"scene_{i}.ass" if r == 0 else f"scene_{i}_r{r}.ass"
+            ass_path = _write_karaoke_ass(plan["text"], plan["duration_s"], rends[r]["target_w"], rends[r]["target_h"],
+                                          font_family, text_color, text_effect, out_dir=workspace, name=ass_name)
+        plan["vf_chain"] = ",".join([*plan["pre_ass"], _subtitles_filter(ass_path, fonts_dir), plan["fades"]])
+
+    def _scene_encode_cmd(i: int, plans: List[dict], targets: List[int], music_starts: dict[int, float]) -> List[str]:
+        """One FFmpeg process for scene i: inputs are read once and split into one
+        filter/encode branch (and output clip) per target rendition."""
+        audio_path = plans[0]["audio_path"]
+        duration_s = plans[0]["duration_s"]
+        # Ảnh tĩnh chỉ đọc một frame; bước motion sinh đủ số frame của cảnh
+        cmd = [ffmpeg_path, "-hide_banner", "-loglevel", "error"]
+        image_inputs: dict[str, int] = {}
+        for r in targets:
+            if plans[r]["img_path"] not in image_inputs:
+                image_inputs[plans[r]["img_path"]] = len(image_inputs)
+                cmd += ["-i", plans[r]["img_path"]]
+        audio_input = len(image_inputs)
+        if audio_path:
+            # -shortest cắt phần audio lẻ sau frame cuối
+            cmd += ["-i", audio_path]
         else:
-            frames = max(1, int(duration_s * 30))
-            zoom = f"zoompan=z='min(zoom+0.0015,1.06)':d={frames}:s={target_w}x{target_h}:fps=30"
-            fades = f"fade=t=in:st=0:d={fade_dur},fade=t=out:st={max(0.0, duration_s-fade_dur)}:d={fade_dur}"
-            parts = [scale_filter]
-            if color_filter:
-                parts.append(color_filter)
-            parts.append(zoom)
-            # Use ASS even without TTS so text animates per selected effect
-            ass_path_no_tts = _write_karaoke_ass(text, duration_s, target_w, target_h, font_path, text_color, text_effect)
-            ass_escaped_no_tts = _escape_path_for_drawtext(ass_path_no_tts)
-            parts.append(f"subtitles='{ass_escaped_no_tts}'")
-            parts.append(fades)
-            vf_chain = ",".join(parts)
             # Add silent track so concat stays consistent
-            cmd = [
-                ffmpeg_path, "-hide_banner", "-loglevel", "error",
-                "-loop", "1", "-i", img_path,
-                "-f", "lavfi", "-t", str(duration_s), "-i", "anullsrc=channel_layout=stereo:sample_rate=44100",
-                "-vf", vf_chain,
-                "-map", "0:v", "-map", "1:a",
-                "-t", str(duration_s),
-                "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", "-y", out_clip
-            ]
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            cmd += ["-f", "lavfi", "-t", str(duration_s), "-i", "anullsrc=channel_layout=stereo:sample_rate=44100"]
+        graph: List[str] = []
+        sources: dict[int, str] = {}
+        for path, index in image_inputs.items():
+            users = [r for r in targets if plans[r]["img_path"] == path]
+            if len(users) == 1:
+                sources[users[0]] = f"[{index}:v]"
+            else:
+                graph.append(f"[{index}:v]split={len(users)}" + "".join(f"[src{r}]" for r in users))
+                sources.update({r: f"[src{r}]" for r in users})
+        for r in targets:
+            graph.append(f"{sources[r]}{plans[r]['vf_chain']}[v{r}]")
+        audio_maps = {r: f"{audio_input}:a" for r in targets}
+        if bgm_path:
+            # Nhạc nền trộn ngay trong clip, bắt đầu tại vị trí cảnh này trong nhạc lặp => nối -c copy vẫn liền mạch
+            cmd += ["-stream_loop", "-1", "-i", bgm_path]
+            voice = {r: f"[{audio_input}:a]" for r in targets}
+            music = {r: f"[{audio_input + 1}:a]" for r in targets}
+            if len(targets) > 1:
+                graph.append(f"[{audio_input}:a]asplit={len(targets)}" + "".join(f"[voice{r}]" for r in targets))
+                graph.append(f"[{audio_input + 1}:a]asplit={len(targets)}" + "".join(f"[bgm{r}]" for r in targets))
+                voice = {r: f"[voice{r}]" for r in targets}
+                music = {r: f"[bgm{r}]" for r in targets}
+            for r in targets:
+                graph.append(f"{music[r]}atrim=start={music_starts[r]},asetpts=PTS-STARTPTS,volume=0.10[music{r}]")
+                graph.append(f"{voice[r]}[music{r}]amix=inputs=2:duration=first:dropout_transition=2[a{r}]")
+                audio_maps[r] = f"[a{r}]"
+        cmd += ["-filter_complex", ";".join(graph)]
+        for r in targets:
+            cmd += ["-map", f"[v{r}]", "-map", audio_maps[r]]
+            if not audio_path:
+                cmd += ["-t", str(duration_s)]
+            # Cùng định dạng audio cho mọi clip để bước nối -c copy không lệch kênh/tần số
+            cmd += [*rends[r]["video_args"], "-threads", str(FFMPEG_THREADS_PER_ENCODE), "-c:a", "aac", "-ar", "44100", "-ac", "2", "-shortest", "-y", clip_paths[r][i - 1]]
+        return cmd
+
+    def _build_scene_cmd(i: int, img_path: str, text: str, tts: tuple[str, float | None] | None) -> List[str] | Future | None:
+        """FFmpeg command for scene i (every rendition whose clip is not cached), None when
+        all clips were restored from the scene cache, or a Future resolving to either while
+        an identical scene is being encoded elsewhere."""
+        plans = [_plan_scene(i, img_path, text, tts, r=r) for r in range(len(rends))]
+        audio_hash = _file_sha256(plans[0]["audio_path"]) if plans[0]["audio_path"] else None
+        keys: dict[int, str] = {}
+        music_starts: dict[int, float] = {}
+        for r, (rend, plan) in enumerate(zip(rends, plans)):
+            clip_seconds[r][i] = plan["frames"] / plan["fps"]
+            music_start = None
+            if bgm_path:
+                music_start = round(bgm_offsets[r][i] % bgm_seconds if bgm_seconds else bgm_offsets[r][i], 3)
+                music_starts[r] = music_start
+            # Khoá cache gồm mọi thứ quyết định nội dung clip
+            key = _DiskLRUCache.make_key(
+                "scene-v8", img_hashes[i - 1], plan["normalized"], text, audio_hash,
+                rend["target_w"], rend["target_h"], color_filter, text_effect, text_color, font_path,
+                fade_dur, plan["zoom"], plan["duration_s"], rend["profile_name"], rend["video_args"], plan["text_filter"],
+                spec.get("bgm_hash") if bgm_path else None, music_start,
+            )
+            if _scene_cache.fetch(key, clip_paths[r][i - 1]) is None:
+                keys[r] = key
+        if not keys:
+            return None
+        scene_keys[i] = keys
+        # Phụ đề chỉ dựng cho các bản thật sự phải encode (cảnh lấy từ cache không cần ASS)
+        for r in keys:
+            _burn_scene_ass(i, plans[r])
+        cmd = _scene_encode_cmd(i, plans, sorted(keys), music_starts)
+        with keys_lock:
+            if aborted:
+                # Job đã dừng (cảnh khác lỗi) trong lúc cảnh này chờ TTS: không nhận thêm khoá nào
+                raise _ScenePrepError("Job đã dừng.")
+            if len(keys) > 1:
+                # Nhiều bản cùng thiếu: encode chung một lệnh; khoá nào job khác đang giữ thì vẫn encode song song
+                for key in keys.values():
+                    if _scene_inflight.claim(key) is None:
+                        owned_keys.add(key)
+                return cmd
+            (r, key), = keys.items()
+            out_clip = clip_paths[r][i - 1]
+            waiter = _scene_inflight.claim(key)
+            if waiter is None:
+                owned_keys.add(key)
+                return cmd
+        # Cảnh giống hệt đang được encode (video khác trong batch, hoặc cảnh trùng trong cùng video)
+        shared: Future = Future()
+
+        def _after_owner(_done: Future) -> None:
+            if shared.cancelled():
+                return
+            restored = _scene_cache.fetch(key, out_clip) is not None
+            try:
+                shared.set_result(None if restored else cmd)
+            except InvalidStateError:
+                pass
+
+        waiter.add_done_callback(_after_owner)
+        return shared
+
+    tts_error = f"TTS không hoạt động. Kiểm tra server TTS tại {', '.join(_tts_supervisor.urls)} (/v1/audio/speech) hoặc đặt TTS_BASE_URL cho đúng."
+
+    def _scene_tts(i: int, text: str) -> tuple[str, float | None] | None:
+        with _job_span(job, "tts", i):
+            return _tts_audio(text, tts_voice, workspace, job)
+
+    def _prepare_tts_scene(i: int, img_path: str, text: str) -> List[str] | Future | None:
+        tts = _scene_tts(i, text)
+        if not tts:
+            raise _ScenePrepError(tts_error)
+        return _build_scene_cmd(i, img_path, text, tts)
+
+    if engine == "single":
+        # TTS vẫn chạy song song, nhưng cả video được dựng bằng một lệnh FFmpeg duy nhất
+        tts_futures = [
+            _tts_pool.submit(_scene_tts, i, text) if use_tts and text else None
+            for i, text in enumerate(lines, start=1)
+        ]
+        plans = []
+        for i, (img_path, text, fut) in enumerate(zip(img_paths, lines, tts_futures), start=1):
+            tts = fut.result() if fut else None
+            if fut and not tts:
+                for other in tts_futures:
+                    if other:
+                        other.cancel()
+                return {"error": tts_error}
+            plans.append(_plan_scene(i, img_path, text, tts, burn_ass=False))
+        subtitle_filter = None
+        if use_ass:
+            # Một file ASS cho cả video, timestamp toàn cục; chữ được phủ sau concat (một lần khởi tạo libass)
+            with _job_span(job, "ass"):
+                events = []
+                offset = 0.0
+                for plan in plans:
+                    scene_s = plan["frames"] / plan["fps"]
+                    if plan["text"]:
+                        events.append(_ass_event(plan["text"], offset, offset + scene_s, target_w, target_h, text_effect, int(fade_dur * 1000)))
+                    offset += scene_s
+                ass_path = _write_ass(os.path.join(workspace, "captions.ass"), _ass_header(target_w, target_h, font_family, text_color), events)
+            subtitle_filter = _subtitles_filter(ass_path, fonts_dir)
+        _set_job_progress(job, 0.2)
+        final_name = f"{uuid.uuid4().hex}.mp4"
+        final_path = os.path.join(workspace, final_name)
+        with _job_span(job, "single_pass"):
+            proc = _run_ffmpeg(_single_pass_cmd(ffmpeg_path, plans, bgm_path, final_path, video_args, subtitle_filter), cancel)
+        if cancel is not None and cancel.is_set():
+            return {"error": JOB_CANCELLED_ERROR}
         if proc.returncode != 0:
-            return {"error": f"FFmpeg tạo clip lỗi (ảnh {i}): {proc.stderr.decode(errors='ignore')}"}
-        clip_paths.append(out_clip)
+            return {"error": f"FFmpeg dựng video lỗi: {proc.stderr.decode(errors='ignore')}"}
+        with _job_span(job, "publish"):
+            _publish_output(final_path, final_name, job_id)
+        return {"url": f"/outputs/{final_name}", "renditions": [_rendition_summary(rends[0], f"/outputs/{final_name}")]}
 
-    # Tạo file list để nối video
-    list_file = os.path.join(OUTPUT_DIR, "list.txt")
-    with open(list_file, "w", encoding="utf-8") as f:
-        for clip in clip_paths:
-            f.write(f"file '{os.path.abspath(clip)}'\n")
+    def _add_clip_paths(i: int) -> None:
+        for r in range(len(rends)):
+            clip_paths[r].append(os.path.join(workspace, f"clip_{i}.mp4" if r == 0 else f"clip_{i}_r{r}.mp4"))
 
-    final_name = f"{uuid.uuid4().hex}.mp4"
-    final_path = os.path.join(OUTPUT_DIR, final_name)
+    # Mọi khoá cảnh đã nhận (kể cả khi TTS của một cảnh sau lỗi giữa vòng dựng lệnh) được nhả trong finally
+    try:
+        if bgm_path:
+            # Vị trí nhạc của cảnh i chỉ phụ thuộc độ dài các cảnh 1..i-1: mỗi cảnh được dựng lệnh ngay khi
+            # có TTS của nó và cảnh trước đã dựng xong, nên encode bắt đầu mà không chờ dòng TTS cuối
+            tts_futures = {i: _tts_pool.submit(_scene_tts, i, text) for i, text in enumerate(lines, start=1) if use_tts and text}
+            preps: List[Future] = [Future() for _ in img_paths]
+
+            def _prepare_bgm_scene(i: int, offsets: List[float]) -> None:
+                prep = preps[i - 1]
+                if not prep.set_running_or_notify_cancel():
+                    return
+                try:
+                    tts = tts_futures[i].result() if i in tts_futures else None
+                    if i in tts_futures and not tts:
+                        raise _ScenePrepError(tts_error)
+                    for r in range(len(rends)):
+                        bgm_offsets[r][i] = offsets[r]
+                    cmd = _build_scene_cmd(i, img_paths[i - 1], lines[i - 1], tts)
+                except BaseException as exc:
+                    for fut in [*tts_futures.values(), *preps[i:]]:
+                        fut.cancel()
+                    prep.set_exception(exc)
+                    return
+                _schedule_bgm_scene(i + 1, [offsets[r] + clip_seconds[r][i] for r in range(len(rends))])
+                prep.set_result(cmd)
+
+            def _schedule_bgm_scene(i: int, offsets: List[float]) -> None:
+                if i > len(preps):
+                    return
+                if i in tts_futures:
+                    tts_futures[i].add_done_callback(lambda _done: _tts_pool.submit(_prepare_bgm_scene, i, offsets))
+                else:
+                    _tts_pool.submit(_prepare_bgm_scene, i, offsets)
+
+            for i in range(1, len(img_paths) + 1):
+                _add_clip_paths(i)
+            scene_cmds.extend(preps)
+            _schedule_bgm_scene(1, [0.0] * len(rends))
+        else:
+            # Toàn bộ các dòng TTS được gửi song song ngay từ đầu; cảnh nào có audio trước thì encode trước
+            for i, (img_path, text) in enumerate(zip(img_paths, lines), start=1):
+                _add_clip_paths(i)
+                if use_tts and text:
+                    scene_cmds.append(_tts_pool.submit(_prepare_tts_scene, i, img_path, text))
+                else:
+                    scene_cmds.append(_build_scene_cmd(i, img_path, text, None))
+
+        # Bản xem trước: phát HLS từng cảnh một trong lúc các cảnh sau còn đang encode
+        playlist = _ProgressivePlaylist(ffmpeg_path, job_id) if preview and PROGRESSIVE_PREVIEW and job_id else None
+        if playlist:
+            _retention.claim(playlist.directory, job_id)
+
+        # Encode các cảnh song song; thứ tự nối vẫn theo chỉ số ảnh
+        encoded = 0
+
+        def _on_scene_done(index: int, result: dict | None) -> None:
+            nonlocal encoded
+            if result is not None:
+                _record_span(job, "encode", result["seconds"], index, result["started"],
+                             **{k: result[k] for k in ("fps", "speed") if k in result})
+            if index in scene_keys and result is not None:
+                for r, key in scene_keys[index].items():
+                    _scene_cache.put(key, clip_paths[r][index - 1])
+                    with keys_lock:
+                        owned = key in owned_keys
+                        owned_keys.discard(key)
+                    if owned:
+                        _scene_inflight.resolve(key)
+            encoded += 1
+            _set_job_progress(job, 0.9 * encoded / n_scenes)
+            if playlist:
+                with _job_span(job, "segment", index):
+                    published = playlist.scene_ready(index, clip_paths[0][index - 1], clip_seconds[0][index])
+                if published and job and not job.get("playlist_url"):
+                    job["playlist_url"] = f"{job['base_prefix']}{playlist.url}"
+
+        error = _run_scene_encodes(scene_cmds, _on_scene_done, cancel)
+    finally:
+        # Cảnh lỗi/bị huỷ vẫn phải nhả khoá để job đang chờ tự encode lấy
+        with keys_lock:
+            aborted = True
+            leftover = list(owned_keys)
+            owned_keys.clear()
+        for key in leftover:
+            _scene_inflight.resolve(key)
+    if error:
+        if playlist:
+            playlist.discard()
+        return {"error": error}
+    if playlist:
+        playlist.finish()
+
+    # Nối video từng rendition (nhạc nền đã nằm sẵn trong từng clip): chỉ copy stream, ghi thẳng ra
+    # tên công khai. Retention đã nhận file từ trước nên không bị dọn khi đang ghi; lỗi thì xoá các file dở.
+    outputs: List[dict] = []
+    with _job_span(job, "concat"):
+        for r, rend in enumerate(rends):
+            list_file = os.path.join(workspace, "list.txt" if r == 0 else f"list_r{r}.txt")
+            with open(list_file, "w", encoding="utf-8") as f:
+                for clip in clip_paths[r]:
+                    f.write(f"file '{os.path.abspath(clip)}'\n")
+            final_name = f"{uuid.uuid4().hex}.mp4"
+            final_path = os.path.join(OUTPUT_DIR, final_name)
+            if job_id:
+                _retention.claim(final_path, job_id)
+            outputs.append(_rendition_summary(rend, f"/outputs/{final_name}"))
+            proc_concat = _run_ffmpeg([
+                ffmpeg_path, "-hide_banner", "-loglevel", "error",
+                "-f", "concat", "-safe", "0", "-i", list_file,
+                "-c", "copy", "-movflags", "+faststart", "-y", final_path
+            ], cancel)
+            if proc_concat.returncode != 0 or (cancel is not None and cancel.is_set()):
+                _remove_outputs(outputs)
+                if cancel is not None and cancel.is_set():
+                    return {"error": JOB_CANCELLED_ERROR}
+                return {"error": f"FFmpeg nối video lỗi: {proc_concat.stderr.decode(errors='ignore')}"}
+    return {"url": outputs[0]["url"], "renditions": outputs}
+
+
+def _script_lines(script: str, filenames: List[str | None]) -> List[str]:
+    """One caption per image: script lines, padded or trimmed to the image count."""
+    # Kịch bản: nếu trống, tự sinh dựa trên tên file; nếu thiếu, tự bù
+    raw_lines = [l.rstrip() for l in (script or "").splitlines()]
+    lines = [l.strip() for l in raw_lines if l.strip()]
+    if not lines:
+        # Tạo kịch bản mặc định từ tên file
+        lines = []
+        for idx, filename in enumerate(filenames, start=1):
+            name = os.path.splitext(os.path.basename(filename or f"ảnh_{idx}.png"))[0]
+            lines.append(name.replace("_", " ") or f"Cảnh {idx}")
+    if len(lines) < len(filenames):
+        # Bổ sung phần còn thiếu
+        for idx in range(len(lines)+1, len(filenames)+1):
+            lines.append(f"Cảnh {idx}")
+    elif len(lines) > len(filenames):
+        lines = lines[:len(filenames)]
+    return lines
+
+
+def _job_spec(workspace: str, img_paths: List[str], img_hashes: List[str], lines: List[str], bgm_path: str | None, bgm_hash: str | None, options: dict, upload_seconds: float | None = None) -> dict:
+    """Queue spec for `_render_video` from saved inputs and the user-facing render options."""
+    preview = bool(options["preview"])
+    engine = options.get("engine") or "multipass"
+    return {
+        "img_paths": img_paths,
+        "img_hashes": img_hashes,
+        "lines": lines,
+        "use_tts": bool(options["use_tts"]),
+        "tts_voice": options["tts_voice"],
+        "aspect": options["aspect"],
+        "color_grade": options["color_grade"],
+        "preview": preview,
+        "bgm_path": bgm_path,
+        "bgm_hash": bgm_hash,
+        "text_color": options["text_color"],
+        "font_name": options["font_name"],
+        "text_effect": options["text_effect"],
+        "motion": options.get("motion") if options.get("motion") in MOTION_PATHS else DEFAULT_MOTION,
+        "motion_ease": options.get("motion_ease") if options.get("motion_ease") in MOTION_EASES else DEFAULT_MOTION_EASE,
+        "engine": engine if engine in RENDER_ENGINES else "multipass",
+        "encoder_profile": _resolve_encoder_profile(options.get("encoder_profile"), preview),
+        "renditions": options.get("renditions") or [],
+        "workspace": workspace,
+        "upload_seconds": upload_seconds,
+    }
 
-    # Nối video
-    proc_concat = subprocess.run([
-        ffmpeg_path, "-hide_banner", "-loglevel", "error",
-        "-f", "concat", "-safe", "0", "-i", list_file,
-        "-c", "copy", "-y", final_path
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if proc_concat.returncode != 0:
-        return {"error": f"FFmpeg nối video lỗi: {proc_concat.stderr.decode(errors='ignore')}"}
-
-    # Nếu có nhạc nền: trộn nhạc sau cùng để nhạc chạy liền mạch toàn bộ video
-    if bgm_path and os.path.isfile(final_path):
-        final_with_bgm = os.path.join(OUTPUT_DIR, f"{uuid.uuid4().hex}.mp4")
-        proc_mix = subprocess.run([
-            ffmpeg_path, "-hide_banner", "-loglevel", "error",
-            "-i", final_path,
-            "-stream_loop", "-1", "-i", bgm_path,
-            "-filter_complex", "[1:a]volume=0.10[music];[0:a][music]amix=inputs=2:duration=first:dropout_transition=2[mix]",
-            "-map", "0:v", "-map", "[mix]",
-            "-c:v", "copy", "-c:a", "aac", "-shortest", "-y", final_with_bgm
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if proc_mix.returncode == 0:
+
+def _human_seconds(seconds: float) -> str:
+    return f"{max(1, math.ceil(seconds))} giây" if seconds < 120 else f"{math.ceil(seconds / 60)} phút"
+
+
+def _job_budget_error(n_scenes: int, estimate: float) -> str | None:
+    """Why a single job is too big to queue at all, or None."""
+    if n_scenes > MAX_SCENES_PER_JOB:
+        return f"Mỗi video tối đa {MAX_SCENES_PER_JOB} ảnh."
+    if estimate > MAX_JOB_RENDER_SECONDS:
+        return (
+            f"Video quá nặng: ước tính ~{_human_seconds(estimate)} render, tối đa {_human_seconds(MAX_JOB_RENDER_SECONDS)}. "
+            "Hãy bớt ảnh hoặc bản xuất thêm, hay chọn hồ sơ encode nhanh hơn."
+        )
+    return None
+
+
+# Giá trị mặc định của các trường form khi client không gửi
+_VIDEO_FORM_DEFAULTS = {
+    "script": "",
+    "use_tts": "false",
+    "tts_voice": "vi-VN-HoaiMyNeural",
+    "aspect": "16:9",
+    "color_grade": "",
+    "text_color": "white",
+    "font_name": "auto",
+    "text_effect": "kf_fill",
+    "engine": "multipass",
+    "encoder_profile": "",
+    "motion": DEFAULT_MOTION,
+    "motion_ease": DEFAULT_MOTION_EASE,
+    "renditions": "",
+}
+
+
+def _form_flag(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def _admission_error(n_scenes: int, estimate: float, pending: float) -> JSONResponse | None:
+    """413 for a job too big to queue at all, 429 (with Retry-After) while the client's
+    outstanding work plus this job would exceed CLIENT_MAX_PENDING_SECONDS, else None."""
+    budget_error = _job_budget_error(n_scenes, estimate)
+    if budget_error:
+        _jobs_total.inc(status="rejected")
+        return JSONResponse(status_code=413, content={"error": budget_error, "estimated_seconds": estimate})
+    # Client chưa có việc nào thì luôn được nhận một job (đã qua ngưỡng từng job ở trên)
+    if pending > 0 and pending + estimate > CLIENT_MAX_PENDING_SECONDS:
+        _jobs_total.inc(status="rejected")
+        retry_after = max(1, math.ceil(pending + estimate - CLIENT_MAX_PENDING_SECONDS))
+        content = {
+            "error": f"Bạn đang có khoảng {_human_seconds(pending)} render chờ xử lý, vui lòng đợi các video trước xong rồi thử lại.",
+            "retry_after_seconds": retry_after,
+        }
+        if estimate:
+            content["estimated_seconds"] = estimate
+        return JSONResponse(status_code=429, headers={"Retry-After": str(retry_after)}, content=content)
+    return None
+
+
+def _queue_full_response() -> JSONResponse:
+    _jobs_total.inc(status="rejected")
+    return JSONResponse(status_code=429, content={"error": "Hàng đợi render đang đầy, vui lòng thử lại sau ít phút."})
+
+
+def _video_options(fields: dict[str, str], filenames: List[str], preview: bool) -> tuple[dict, List[str]]:
+    """(render options, caption lines) from the form fields; ValueError for bad renditions."""
+    fields = {**_VIDEO_FORM_DEFAULTS, **fields}
+    extra_renditions = _parse_renditions(fields["renditions"], fields["aspect"], preview, fields["encoder_profile"])
+    options = {
+        "use_tts": _form_flag(fields["use_tts"]), "tts_voice": fields["tts_voice"], "aspect": fields["aspect"], "color_grade": fields["color_grade"],
+        "preview": preview, "text_color": fields["text_color"], "font_name": fields["font_name"],
+        "text_effect": fields["text_effect"], "engine": fields["engine"], "encoder_profile": fields["encoder_profile"],
+        "motion": fields["motion"], "motion_ease": fields["motion_ease"], "renditions": extra_renditions,
+    }
+    return options, _script_lines(fields["script"], filenames)
+
+
+async def _create_video_multi_impl(request: Request, preview: bool = False):
+    # Kiểm tra FFmpeg sớm (tìm nhiều vị trí phổ biến trên Windows) để báo lỗi ngay, không cần xếp hàng
+    # (chỉ dò lại khi chưa tìm thấy, để người dùng cài FFmpeg xong không phải khởi động lại)
+    if not _get_toolchain()["ffmpeg"] and not _get_toolchain(refresh=True)["ffmpeg"]:
+        return {"error": "FFmpeg chưa được cài hoặc chưa có trong PATH. Hãy cài bằng winget: winget install --id FFmpeg.FFmpeg -e --source winget"}
+    # Từ chối theo Content-Length trước khi đọc byte nào của body
+    if _declared_too_large(request):
+        return JSONResponse(status_code=413, content={"error": _request_too_large_message()})
+
+    # Kiểm soát tải chỉ dựa trên header, trước khi nhận upload: hàng đợi đầy, hoặc client đã
+    # giữ đủ ngân sách render chờ xử lý thì job nào cũng bị từ chối, khỏi phải tải ảnh lên.
+    # Chỉ đếm job gửi trực tiếp: job batch có giới hạn riêng và được xen kẽ khi dispatch
+    client = _client_id(request)
+    queue = _job_queue.stats()
+    if queue["queued"] - queue["queued_batch"] >= queue["limit"]:
+        return _queue_full_response()
+    pending = _job_queue.outstanding(client)
+    rejected = _admission_error(0, 0.0, pending)
+    if rejected:
+        return rejected
+
+    upload_started = time.perf_counter()
+    # Mỗi job có workspace riêng nên các request đồng thời không ghi đè file của nhau
+    job_id = uuid.uuid4().hex
+    workspace = _create_job_workspace()
+    _retention.claim(workspace, job_id)
+    filenames: List[str] = []
+    fields_first: bool | None = None
+
+    def _file_dst(field: str, filename: str, form: dict[str, str]) -> str | None:
+        nonlocal fields_first
+        if field == "bgm":
+            return os.path.join(workspace, f"bgm_{os.path.basename(filename or 'bgm.mp3')}")
+        if field != "images":
+            return None
+        filenames.append(filename)
+        if fields_first is None:
+            fields_first = bool(form)
+        # Ước tính lại mỗi khi có thêm ảnh (chi phí chỉ tăng theo số ảnh): job vượt ngân sách bị
+        # từ chối ngay, không đợi tải hết. Chỉ làm khi các trường lựa chọn đã tới trước tệp.
+        estimate = 0.0
+        if fields_first:
             try:
-                os.replace(final_with_bgm, final_path)
-            except Exception:
-                final_path = final_with_bgm
+                options, lines = _video_options(form, filenames, preview)
+                estimate = _cost_model.estimate(dict(options, lines=lines))
+            except ValueError:
+                pass  # renditions sai: trả 400 sau khi đọc xong body
+        rejected = _admission_error(len(filenames), estimate, pending)
+        if rejected:
+            raise _UploadRejected(rejected)
+        return os.path.join(workspace, f"img_{len(filenames)}_{os.path.basename(filename or 'image.png')}")
+
+    # Ảnh/nhạc được ghi xuống workspace theo từng khối ngay khi tới, băm nội dung trong lúc ghi
+    try:
+        form, uploads = await _read_multipart(request, _file_dst)
+        if not any(u["field"] == "images" for u in uploads):
+            raise _BadUpload("Cần ít nhất một ảnh.")
+    except (_UploadTooLarge, _BadUpload, _UploadRejected) as exc:
+        _remove_job_workspace(workspace)
+        _retention.release(job_id)
+        if isinstance(exc, _UploadRejected):
+            return exc.response
+        return JSONResponse(status_code=413 if isinstance(exc, _UploadTooLarge) else 400, content={"error": str(exc)})
+    except BaseException:
+        # Client ngắt kết nối giữa chừng, ...: không để lại workspace dở
+        _remove_job_workspace(workspace)
+        _retention.release(job_id)
+        raise
+    images = [u for u in uploads if u["field"] == "images"]
+    img_paths = [u["path"] for u in images]
+    img_hashes = [u["sha256"] for u in images]
+    # Nhạc nền rỗng (ô chọn file để trống) thì coi như không có
+    bgm = next((u for u in uploads if u["field"] == "bgm" and u["size"] > 0), None)
+    bgm_path = bgm["path"] if bgm else None
+    bgm_hash = bgm["sha256"] if bgm else None
+
+    def _reject(response: JSONResponse) -> JSONResponse:
+        _remove_job_workspace(workspace)
+        _retention.release(job_id)
+        return response
 
-    # Trả về URL công khai, tự động thêm tiền tố /VIDEO nếu người dùng đang dưới /VIDEO/
+    try:
+        options, lines = _video_options(form, [u["filename"] for u in images], preview)
+    except ValueError as exc:
+        return _reject(JSONResponse(status_code=400, content={"error": str(exc)}))
+    options["font_name"] = _caption_font(options["font_name"])
+
+    # Kiểm tra lần cuối với đủ ảnh và mọi trường (kể cả trường gửi sau tệp); tải của client có thể đã đổi
+    estimate = _cost_model.estimate(dict(options, lines=lines))
+    rejected = _admission_error(len(images), estimate, _job_queue.outstanding(client))
+    if rejected:
+        return _reject(rejected)
+
+    spec = _job_spec(workspace, img_paths, img_hashes, lines, bgm_path, bgm_hash, options, upload_seconds=time.perf_counter() - upload_started)
+    # URL công khai tự động thêm tiền tố /VIDEO nếu người dùng đang dưới /VIDEO/
     base_prefix = "/VIDEO" if str(request.url.path).startswith("/VIDEO/") else ""
-    return {"url": f"{base_prefix}/outputs/{final_name}"}
+    job = _job_queue.submit(spec, base_prefix, job_id, client=client, estimate=estimate)
+    if job is None:
+        return _reject(_queue_full_response())
+    return _job_queue.snapshot(job["id"])
 
 
+# Các endpoint nhận body multipart thô (xem _read_multipart) thay vì khai báo File/Form,
+# để FastAPI không đọc trước toàn bộ body
 @app.post("/create_video_multi")
-async def create_video_multi(request: Request, images: List[UploadFile] = File(...), script: str = Form("") , use_tts: bool = Form(False), tts_voice: str = Form("vi-VN-HoaiMyNeural"), aspect: str = Form("16:9"), color_grade: str = Form("") , bgm: UploadFile | None = File(None), text_color: str = Form("white"), font_name: str = Form("auto"), text_effect: str = Form("kf_fill")):
-    return await _create_video_multi_impl(request, images, script, use_tts, tts_voice, aspect, color_grade, preview=False, bgm=bgm, text_color=text_color, font_name=font_name, text_effect=text_effect)
+async def create_video_multi(request: Request):
+    return await _create_video_multi_impl(request, preview=False)
 
 
 @app.post("/VIDEO/create_video_multi")
-async def create_video_multi_under_video(request: Request, images: List[UploadFile] = File(...), script: str = Form("") , use_tts: bool = Form(False), tts_voice: str = Form("vi-VN-HoaiMyNeural"), aspect: str = Form("16:9"), color_grade: str = Form("") , bgm: UploadFile | None = File(None), text_color: str = Form("white"), font_name: str = Form("auto"), text_effect: str = Form("kf_fill")):
-    return await _create_video_multi_impl(request, images, script, use_tts, tts_voice, aspect, color_grade, preview=False, bgm=bgm, text_color=text_color, font_name=font_name, text_effect=text_effect)
+async def create_video_multi_under_video(request: Request):
+    return await _create_video_multi_impl(request, preview=False)
 
 
 @app.post("/preview_video_multi")
-async def preview_video_multi(request: Request, images: List[UploadFile] = File(...), script: str = Form("") , use_tts: bool = Form(False), tts_voice: str = Form("vi-VN-HoaiMyNeural"), aspect: str = Form("16:9"), color_grade: str = Form("") , bgm: UploadFile | None = File(None), text_color: str = Form("white"), font_name: str = Form("auto"), text_effect: str = Form("kf_fill")):
-    return await _create_video_multi_impl(request, images, script, use_tts, tts_voice, aspect, color_grade, preview=True, bgm=bgm, text_color=text_color, font_name=font_name, text_effect=text_effect)
+async def preview_video_multi(request: Request):
+    return await _create_video_multi_impl(request, preview=True)
 
 
 @app.post("/VIDEO/preview_video_multi")
-async def preview_video_multi_under_video(request: Request, images: List[UploadFile] = File(...), script: str = Form("") , use_tts: bool = Form(False), tts_voice: str = Form("vi-VN-HoaiMyNeural"), aspect: str = Form("16:9"), color_grade: str = Form("") , bgm: UploadFile | None = File(None), text_color: str = Form("white"), font_name: str = Form("auto"), text_effect: str = Form("kf_fill")):
-    return await _create_video_multi_impl(request, images, script, use_tts, tts_voice, aspect, color_grade, preview=True, bgm=bgm, text_color=text_color, font_name=font_name, text_effect=text_effect)
+async def preview_video_multi_under_video(request: Request):
+    return await _create_video_multi_impl(request, preview=True)
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    snap = _job_queue.snapshot(job_id)
+    if snap is None:
+        return JSONResponse(status_code=404, content={"error": "Không tìm thấy job."})
+    return snap
+
+
+@app.get("/VIDEO/jobs/{job_id}")
+def job_status_under_video(job_id: str):
+    return job_status(job_id)
+
+
+# ---------- Shared assets + batch rendering ----------
+# Ảnh/nhạc được tải lên một lần (lưu theo sha256) rồi nhiều video trong batch tham chiếu lại.
+# Asset hết hạn theo ASSET_TTL_SECONDS kể từ lần dùng cuối (không theo TTL file tạm của UPLOAD_DIR).
+BATCH_MAX_VIDEOS = max(1, _env_int("BATCH_MAX_VIDEOS", 200))
+# Số job batch đang chờ tối đa của một client, để một client không chiếm hết BATCH_QUEUE_LIMIT
+BATCH_CLIENT_MAX_QUEUED = max(1, min(_env_int("BATCH_CLIENT_MAX_QUEUED", BATCH_MAX_VIDEOS), BATCH_QUEUE_LIMIT // 2))
+_BATCH_VIDEO_DEFAULTS = {
+    "script": "",
+    "use_tts": False,
+    "tts_voice": "vi-VN-HoaiMyNeural",
+    "aspect": "16:9",
+    "color_grade": "",
+    "preview": False,
+    "bgm": None,
+    "text_color": "white",
+    "font_name": "auto",
+    "text_effect": "kf_fill",
+    "engine": "multipass",
+    "encoder_profile": "",
+    "motion": DEFAULT_MOTION,
+    "motion_ease": DEFAULT_MOTION_EASE,
+    "renditions": [],
+}
+
+
+def _asset_path(digest) -> str | None:
+    """Stored asset for a sha256 hex digest, or None if unknown; marks the asset as used."""
+    digest = str(digest or "").lower()
+    if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+        return None
+    path = os.path.join(UPLOAD_DIR, f"asset_{digest}")
+    if not os.path.isfile(path):
+        return None
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return path
+
+
+async def _upload_assets_impl(request: Request):
+    if _declared_too_large(request):
+        return JSONResponse(status_code=413, content={"error": _request_too_large_message()})
+    part_paths: List[str] = []
+
+    def _file_dst(field: str, filename: str, _fields: dict[str, str]) -> str | None:
+        if field != "files":
+            return None
+        part_paths.append(os.path.join(UPLOAD_DIR, f".asset_{uuid.uuid4().hex}.part"))
+        return part_paths[-1]
+
+    try:
+        _form, uploads = await _read_multipart(request, _file_dst)
+        if not uploads:
+            raise _BadUpload("Cần ít nhất một tệp trong trường 'files'.")
+    except BaseException as exc:
+        for path in part_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if isinstance(exc, (_UploadTooLarge, _BadUpload)):
+            return JSONResponse(status_code=413 if isinstance(exc, _UploadTooLarge) else 400, content={"error": str(exc)})
+        raise
+    assets = []
+    for upload in uploads:
+        existing = _asset_path(upload["sha256"])
+        if existing:
+            os.remove(upload["path"])
+        else:
+            os.replace(upload["path"], os.path.join(UPLOAD_DIR, f"asset_{upload['sha256']}"))
+        assets.append({"hash": upload["sha256"], "filename": upload["filename"], "size": upload["size"], "existed": bool(existing)})
+    return {"assets": assets}
+
+
+@app.post("/assets")
+async def upload_assets(request: Request):
+    return await _upload_assets_impl(request)
+
+
+@app.post("/VIDEO/assets")
+async def upload_assets_under_video(request: Request):
+    return await _upload_assets_impl(request)
+
+
+@app.get("/assets/{digest}")
+def asset_info(digest: str):
+    path = _asset_path(digest)
+    if path is None:
+        return JSONResponse(status_code=404, content={"error": "Không tìm thấy asset."})
+    return {"hash": digest.lower(), "size": os.path.getsize(path)}
+
+
+@app.get("/VIDEO/assets/{digest}")
+def asset_info_under_video(digest: str):
+    return asset_info(digest)
+
+
+def _create_batch_impl(request: Request, manifest: dict):
+    """Queue one render job per manifest entry; all inputs are hard-linked from the asset store."""
+    if not _get_toolchain()["ffmpeg"] and not _get_toolchain(refresh=True)["ffmpeg"]:
+        return {"error": "FFmpeg chưa được cài hoặc chưa có trong PATH. Hãy cài bằng winget: winget install --id FFmpeg.FFmpeg -e --source winget"}
+    videos = manifest.get("videos") if isinstance(manifest, dict) else None
+    if not isinstance(videos, list) or not videos:
+        return JSONResponse(status_code=400, content={"error": "Manifest cần có danh sách 'videos'."})
+    if len(videos) > BATCH_MAX_VIDEOS:
+        return JSONResponse(status_code=400, content={"error": f"Mỗi batch tối đa {BATCH_MAX_VIDEOS} video."})
+    defaults = manifest.get("defaults") if isinstance(manifest.get("defaults"), dict) else {}
+
+    # Kiểm tra toàn bộ manifest trước khi xếp hàng job nào
+    entries = []
+    for n, video in enumerate(videos, start=1):
+        if not isinstance(video, dict):
+            return JSONResponse(status_code=400, content={"error": f"Video {n}: cần là một object."})
+        options = {**_BATCH_VIDEO_DEFAULTS, **defaults, **video}
+        for flag in ("use_tts", "preview"):
+            options[flag] = _form_flag(options[flag])
+        images = options.get("images")
+        if not isinstance(images, list) or not images:
+            return JSONResponse(status_code=400, content={"error": f"Video {n}: thiếu danh sách 'images' (hash asset)."})
+        sources = [_asset_path(h) for h in images]
+        if None in sources:
+            missing = images[sources.index(None)]
+            return JSONResponse(status_code=400, content={"error": f"Video {n}: không tìm thấy asset {missing}. Tải lên qua /assets trước."})
+        try:
+            options["renditions"] = _parse_renditions(options["renditions"], options["aspect"], options["preview"], options["encoder_profile"])
+        except ValueError as exc:
+            return JSONResponse(status_code=400, content={"error": f"Video {n}: {exc}"})
+        options["font_name"] = _caption_font(options["font_name"])
+        bgm_source = _asset_path(options["bgm"]) if options["bgm"] else None
+        if options["bgm"] and bgm_source is None:
+            return JSONResponse(status_code=400, content={"error": f"Video {n}: không tìm thấy asset nhạc nền {options['bgm']}."})
+        options["lines"] = _script_lines(options["script"], [None] * len(images))
+        estimate = _cost_model.estimate(options)
+        budget_error = _job_budget_error(len(images), estimate)
+        if budget_error:
+            return JSONResponse(status_code=413, content={"error": f"Video {n}: {budget_error}", "estimated_seconds": estimate})
+        entries.append((options, [str(h).lower() for h in images], sources, bgm_source, estimate))
+    # Batch chạy nền với hàng đợi riêng; mỗi client chỉ giữ tối đa BATCH_CLIENT_MAX_QUEUED job
+    # batch đang chờ, bộ lập lịch xen kẽ chúng với việc của client khác
+    client = _client_id(request)
+    if _job_queue.queued_jobs(True, client) + len(entries) > BATCH_CLIENT_MAX_QUEUED:
+        _jobs_total.inc(len(entries), status="rejected")
+        return JSONResponse(status_code=429, content={"error": f"Mỗi client chỉ được có tối đa {BATCH_CLIENT_MAX_QUEUED} video batch đang chờ render."})
+    queue = _job_queue.stats()
+    if queue["queued_batch"] + len(entries) > queue["batch_limit"]:
+        _jobs_total.inc(len(entries), status="rejected")
+        return JSONResponse(status_code=429, content={"error": "Hàng đợi render đang đầy, vui lòng thử lại sau ít phút."})
+
+    base_prefix = "/VIDEO" if str(request.url.path).startswith("/VIDEO/") else ""
+    batch = {"id": uuid.uuid4().hex, "created_at": time.time(), "base_prefix": base_prefix, "videos": []}
+    for n, (options, img_hashes, sources, bgm_source, estimate) in enumerate(entries, start=1):
+        job_id = uuid.uuid4().hex
+        workspace = _create_job_workspace()
+        _retention.claim(workspace, job_id)
+        img_paths = []
+        for idx, (digest, src) in enumerate(zip(img_hashes, sources), start=1):
+            dst = os.path.join(workspace, f"img_{idx}_{digest[:16]}")
+            _link_or_copy(src, dst)
+            img_paths.append(dst)
+        bgm_path = bgm_hash = None
+        if bgm_source:
+            bgm_hash = str(options["bgm"]).lower()
+            bgm_path = os.path.join(workspace, f"bgm_{bgm_hash[:16]}")
+            _link_or_copy(bgm_source, bgm_path)
+        spec = _job_spec(workspace, img_paths, img_hashes, options["lines"], bgm_path, bgm_hash, options)
+        job = _job_queue.submit(spec, base_prefix, job_id, client=client, estimate=estimate, batch=True)
+        if job is None:
+            _remove_job_workspace(workspace)
+            _retention.release(job_id)
+            _jobs_total.inc(status="rejected")
+            job_id = None
+        batch["videos"].append({"index": n, "name": options.get("name"), "job_id": job_id})
+    # Thành phần batch nằm cùng kho job: backend sqlite giữ được qua lần khởi động lại web
+    _job_queue.save_batch(batch)
+    return _batch_snapshot(batch)
+
+
+def _batch_snapshot(batch: dict) -> dict:
+    videos = []
+    counts: dict[str, int] = {}
+    for entry in batch["videos"]:
+        snap = _job_queue.snapshot(entry["job_id"]) if entry["job_id"] else None
+        if snap is None:
+            status = "rejected" if entry["job_id"] is None else "expired"
+            snap = {"job_id": entry["job_id"], "status": status, "url": None, "error": None}
+        else:
+            snap.pop("spans", None)
+        counts[snap["status"]] = counts.get(snap["status"], 0) + 1
+        videos.append({"index": entry["index"], "name": entry["name"], **snap})
+    finished = sum(counts.get(s, 0) for s in ("done", "failed", "rejected", "expired"))
+    etas = [v["eta_seconds"] for v in videos if v.get("eta_seconds") is not None]
+    return {
+        "batch_id": batch["id"],
+        "status": "done" if finished == len(videos) else "running",
+        "status_url": f"{batch['base_prefix']}/batch/{batch['id']}",
+        "total": len(videos),
+        "counts": counts,
+        "eta_seconds": max(etas) if etas else None,
+        "videos": videos,
+    }
+
+
+@app.post("/batch")
+def create_batch(request: Request, manifest: dict = Body(...)):
+    return _create_batch_impl(request, manifest)
+
+
+@app.post("/VIDEO/batch")
+def create_batch_under_video(request: Request, manifest: dict = Body(...)):
+    return _create_batch_impl(request, manifest)
+
+
+@app.get("/batch/{batch_id}")
+def batch_status(batch_id: str):
+    batch = _job_queue.load_batch(batch_id)
+    if batch is None:
+        return JSONResponse(status_code=404, content={"error": "Không tìm thấy batch."})
+    return _batch_snapshot(batch)
+
+
+@app.get("/VIDEO/batch/{batch_id}")
+def batch_status_under_video(batch_id: str):
+    return batch_status(batch_id)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,283 @@
+"""Render pipeline benchmark.
+
+Generates synthetic image sets, starts the stub TTS server and drives
+`_create_video_multi_impl` through the job queue for a matrix of cases. Each case runs
+in a fresh interpreter with empty caches (unless --warm-cache), so wall time, CPU time
+and peak RSS belong to that case alone. Results are printed as JSON for comparison
+across commits.
+
+    python benchmarks/bench_render.py                       # default sweep
+    python benchmarks/bench_render.py --full --out bench.json
+    python benchmarks/bench_render.py --scenes 20 --resolutions 4000x3000 --engines multipass,single
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows: chỉ đo được CPU của chính tiến trình
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from stub_tts import make_server  # noqa: E402
+
+ASPECTS = ("16:9", "9:16", "1:1")
+TEXT_EFFECTS = ("kf_fill", "k_word", "typewriter", "fade_in", "pop")
+COLOR_GRADES = ("", "warm", "cool", "cinematic", "bw")
+MOTIONS = ("zoom_hold", "zoom_in", "zoom_out", "pan_left", "pan_right", "pan_up", "pan_down", "none")
+EASES = ("linear", "ease_in", "ease_out", "ease_in_out")
+FILLER = "ánh nắng chiều trên con phố nhỏ và những câu chuyện chưa kể".split()
+
+
+def _csv(value: str) -> list[str]:
+    return [v.strip() for v in value.split(",") if v.strip() or v == ""]
+
+
+def _script_for(scenes: int) -> str:
+    # Độ dài dòng thay đổi để TTS stub trả về clip dài ngắn khác nhau
+    return "\n".join(
+        f"Cảnh {i}: " + " ".join(FILLER[: 3 + (i * 5) % len(FILLER)])
+        for i in range(1, scenes + 1)
+    )
+
+
+def _make_images(ffmpeg_path: str, out_dir: str, resolution: str, count: int) -> list[str]:
+    paths = []
+    for i in range(count):
+        path = os.path.join(out_dir, f"{resolution}_{i + 1}.jpg")
+        if not os.path.isfile(path):
+            # Mỗi ảnh một pattern khác nhau để cache không gộp chúng lại
+            subprocess.run([
+                ffmpeg_path, "-hide_banner", "-loglevel", "error",
+                "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate=1,hue=h={i * 37}",
+                "-frames:v", "1", "-q:v", "3", "-y", path,
+            ], check=True)
+        paths.append(path)
+    return paths
+
+
+def build_cases(args) -> list[dict]:
+    base = {
+        "resolution": args.resolutions[0],
+        "scenes": args.scenes[0],
+        "aspect": "16:9",
+        "preview": True,
+        "text_effect": "kf_fill",
+        "color_grade": "",
+        "engine": args.engines[0],
+        "encoder_profile": args.profiles[0],
+        "motion": args.motions[0],
+        "motion_ease": args.eases[0],
+        "renditions": args.renditions,
+        "use_tts": not args.no_tts,
+    }
+    if args.full:
+        grid = itertools.product(
+            args.resolutions, args.scenes, args.aspects, args.modes, args.effects, args.grades, args.engines, args.profiles, args.motions, args.eases,
+        )
+        return [
+            dict(base, resolution=r, scenes=n, aspect=a, preview=(m == "preview"), text_effect=e, color_grade=g, engine=eng, encoder_profile=prof, motion=mo, motion_ease=ea)
+            for r, n, a, m, e, g, eng, prof, mo, ea in grid
+        ]
+    # Mặc định: quét từng yếu tố quanh cấu hình gốc + toàn bộ tổ hợp hiệu ứng chữ x màu
+    cases = []
+    cases += [dict(base, resolution=r, scenes=n) for r in args.resolutions for n in args.scenes]
+    cases += [dict(base, aspect=a, preview=(m == "preview")) for a in args.aspects for m in args.modes]
+    cases += [dict(base, text_effect=e, color_grade=g) for e in args.effects for g in args.grades]
+    cases += [dict(base, engine=eng) for eng in args.engines]
+    cases += [dict(base, encoder_profile=prof, preview=(m == "preview")) for prof in args.profiles for m in args.modes]
+    cases += [dict(base, motion=mo, motion_ease=ea) for mo in args.motions for ea in args.eases]
+    unique = []
+    for case in cases:
+        if case not in unique:
+            unique.append(case)
+    return unique
+
+
+def _usage() -> dict:
+    if resource is None:
+        return {"cpu_s": time.process_time(), "self_rss_kb": None, "children_rss_kb": None}
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss: KB trên Linux, byte trên macOS
+    scale = 1024 if sys.platform == "darwin" else 1
+    return {
+        "cpu_s": own.ru_utime + own.ru_stime + kids.ru_utime + kids.ru_stime,
+        "self_rss_kb": own.ru_maxrss // scale,
+        "children_rss_kb": kids.ru_maxrss // scale,
+    }
+
+
+def _multipart_body(fields: dict, files: list[tuple[str, str]]) -> tuple[str, bytes]:
+    """(content type, body) of a multipart/form-data request: text fields first, then files."""
+    boundary = "bench" + os.urandom(8).hex()
+    out = bytearray()
+    for name, value in fields.items():
+        out += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+    for name, path in files:
+        out += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{os.path.basename(path)}"\r\n'.encode()
+        out += b"Content-Type: application/octet-stream\r\n\r\n"
+        with open(path, "rb") as f:
+            out += f.read()
+        out += b"\r\n"
+    out += f"--{boundary}--\r\n".encode()
+    return f"multipart/form-data; boundary={boundary}", bytes(out)
+
+
+def run_case(case: dict) -> dict:
+    """Executed in a child interpreter: render one case through the real intake + job queue."""
+    sys.path.insert(0, REPO_DIR)
+    import app  # noqa: E402  (import sau khi môi trường đã được đặt)
+    from starlette.requests import Request
+
+    path = "/preview_video_multi" if case["preview"] else "/create_video_multi"
+    content_type, body = _multipart_body({
+        "script": case["script"], "use_tts": str(case["use_tts"]).lower(), "tts_voice": "vi-VN-HoaiMyNeural",
+        "aspect": case["aspect"], "color_grade": case["color_grade"], "text_effect": case["text_effect"],
+        "engine": case["engine"], "encoder_profile": case["encoder_profile"],
+        "motion": case["motion"], "motion_ease": case["motion_ease"], "renditions": case.get("renditions", ""),
+    }, [("images", p) for p in case["images"]])
+    headers = [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+    chunks = [body[i:i + 65536] for i in range(0, len(body), 65536)] or [b""]
+
+    async def receive() -> dict:
+        # Body tới theo từng khối như qua mạng, để đo cả đường đọc stream của intake
+        chunk = chunks.pop(0)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    request = Request({"type": "http", "method": "POST", "path": path, "headers": headers}, receive)
+
+    before = _usage()
+    started = time.perf_counter()
+    response = asyncio.run(app._create_video_multi_impl(request, preview=case["preview"]))
+    if not isinstance(response, dict) or "job_id" not in response:
+        body = getattr(response, "body", b"")
+        return {"status": "rejected", "error": body.decode(errors="ignore") if body else str(response)}
+    snap = response
+    while snap["status"] in ("queued", "running"):
+        time.sleep(0.05)
+        snap = app._job_queue.snapshot(response["job_id"])
+    wall = time.perf_counter() - started
+    after = _usage()
+
+    stages: dict[str, dict] = {}
+    for span in snap.get("spans", []):
+        agg = stages.setdefault(span["stage"], {"seconds": 0.0, "count": 0})
+        agg["seconds"] = round(agg["seconds"] + span["seconds"], 4)
+        agg["count"] += 1
+    result = {
+        "status": snap["status"],
+        "error": snap.get("error"),
+        "wall_s": round(wall, 3),
+        "cpu_s": round(after["cpu_s"] - before["cpu_s"], 3),
+        "peak_rss_kb": after["self_rss_kb"],
+        "ffmpeg_peak_rss_kb": after["children_rss_kb"],
+        "stages": stages,
+    }
+    # Không để file benchmark tích tụ trong outputs/: MP4 của mọi bản xuất và thư mục HLS xem trước
+    for url in {snap.get("url")} | {r["url"] for r in snap.get("renditions") or []}:
+        if not url:
+            continue
+        try:
+            os.remove(os.path.join(app.OUTPUT_DIR, os.path.basename(url)))
+        except OSError:
+            pass
+    if snap.get("playlist_url"):
+        shutil.rmtree(os.path.join(app.OUTPUT_DIR, os.path.basename(os.path.dirname(snap["playlist_url"]))), ignore_errors=True)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the video render pipeline.")
+    parser.add_argument("--resolutions", type=_csv, default=_csv("1600x1200,4000x3000"), help="source image sizes")
+    parser.add_argument("--scenes", type=lambda v: [int(x) for x in _csv(v)], default=[3, 10], help="scene counts")
+    parser.add_argument("--aspects", type=_csv, default=list(ASPECTS))
+    parser.add_argument("--modes", type=_csv, default=["preview", "final"])
+    parser.add_argument("--effects", type=_csv, default=list(TEXT_EFFECTS))
+    parser.add_argument("--grades", type=_csv, default=list(COLOR_GRADES), help='color grades ("" = none)')
+    parser.add_argument("--engines", type=_csv, default=["multipass", "single"])
+    parser.add_argument("--profiles", type=_csv, default=["", "draft", "standard", "archive"], help='encoder profiles ("" = mode default)')
+    parser.add_argument("--motions", type=_csv, default=["zoom_hold", "zoom_in", "pan_left", "none"], help=f"Ken Burns paths ({', '.join(MOTIONS)})")
+    parser.add_argument("--eases", type=_csv, default=["linear", "ease_in_out"], help=f"motion easing ({', '.join(EASES)})")
+    parser.add_argument("--renditions", default="", help='extra outputs per job, e.g. "9:16,1:1" (same syntax as the form field)')
+    parser.add_argument("--full", action="store_true", help="run the full cross product instead of the sweep")
+    parser.add_argument("--no-tts", action="store_true", help="render without voice-over")
+    parser.add_argument("--tts-latency", type=float, default=0.3, help="stub TTS delay per request (seconds)")
+    parser.add_argument("--warm-cache", action="store_true", help="share caches across cases instead of starting cold")
+    parser.add_argument("--ffmpeg", default=shutil.which("ffmpeg") or "ffmpeg")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return
+
+    work = tempfile.mkdtemp(prefix="bench_")
+    server = make_server(0, args.tts_latency, args.ffmpeg)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tts_url = f"http://127.0.0.1:{server.server_address[1]}"
+    shared_cache = os.path.join(work, "cache")
+    try:
+        cases = build_cases(args)
+        results = []
+        for n, case in enumerate(cases, start=1):
+            images = _make_images(args.ffmpeg, work, case["resolution"], case["scenes"])
+            env = dict(
+                os.environ,
+                TTS_BASE_URL=tts_url,
+                DISABLE_TTS_AUTOSTART="1",
+                CACHE_DIR=shared_cache if args.warm_cache else os.path.join(work, f"cache_{n}"),
+                RENDER_SCRATCH_DIR=os.path.join(work, "scratch"),
+            )
+            payload = dict(case, images=images, script=_script_for(case["scenes"]))
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(payload)],
+                env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=REPO_DIR,
+            )
+            try:
+                measured = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+            except (ValueError, IndexError):
+                measured = {"status": "crashed", "error": proc.stderr.decode(errors="ignore")[-2000:]}
+            results.append(dict(case, **measured))
+            if not args.warm_cache:
+                shutil.rmtree(env["CACHE_DIR"], ignore_errors=True)
+            print(f"[{n}/{len(cases)}] {json.dumps(case, ensure_ascii=False)} -> {measured.get('status')} {measured.get('wall_s')}s", file=sys.stderr)
+    finally:
+        server.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip() or None
+    except OSError:
+        commit = None
+    report = {
+        "commit": commit,
+        "timestamp": time.time(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count()},
+        "settings": {"tts_latency": args.tts_latency, "warm_cache": args.warm_cache, "use_tts": not args.no_tts},
+        "cases": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Stand-in for the openai-edge-tts server used by benchmarks and local testing.
+
+Serves POST /v1/audio/speech with canned MP3s (a quiet tone whose length grows with the
+input text) after a configurable delay, and GET /docs so the app's health probe sees it
+as alive. Requires ffmpeg with libmp3lame to build the canned clips.
+
+    python benchmarks/stub_tts.py --port 5050 --latency 0.4
+
+The app can also run a pool of these in place of edge-tts:
+
+    TTS_POOL_SIZE=3 TTS_BACKEND_CMD="{python} benchmarks/stub_tts.py --port {port} --latency 0.4" python app.py
+"""
+import argparse
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+# Giọng đọc thật ~14 ký tự/giây; làm tròn độ dài theo bước 0.5s để tái dùng clip
+CHARS_PER_SECOND = 14.0
+MIN_SECONDS = 1.0
+MAX_SECONDS = 8.0
+
+
+class CannedAudio:
+    """MP3 clips keyed by duration bucket, generated once with ffmpeg and kept in memory."""
+
+    def __init__(self, ffmpeg_path: str) -> None:
+        self.ffmpeg_path = ffmpeg_path
+        self._clips: dict[float, bytes] = {}
+        self._lock = threading.Lock()
+
+    def for_text(self, text: str) -> bytes:
+        seconds = min(MAX_SECONDS, max(MIN_SECONDS, len(text) / CHARS_PER_SECOND))
+        return self.get(round(seconds * 2) / 2)
+
+    def get(self, seconds: float) -> bytes:
+        with self._lock:
+            if seconds not in self._clips:
+                self._clips[seconds] = self._render(seconds)
+            return self._clips[seconds]
+
+    def _render(self, seconds: float) -> bytes:
+        fd, path = tempfile.mkstemp(suffix=".mp3")
+        os.close(fd)
+        try:
+            subprocess.run([
+                self.ffmpeg_path, "-hide_banner", "-loglevel", "error",
+                "-f", "lavfi", "-i", f"sine=frequency=220:duration={seconds}",
+                "-af", "volume=0.2", "-ac", "2", "-ar", "24000",
+                "-c:a", "libmp3lame", "-b:a", "48k", "-y", path,
+            ], check=True)
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+
+def make_server(port: int, latency: float, ffmpeg_path: str, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    audio = CannedAudio(ffmpeg_path)
+    stats = {"requests": 0}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            if self.path.rstrip("/") != "/v1/audio/speech":
+                self._reply(404, b"not found", "text/plain")
+                return
+            try:
+                text = json.loads(body or b"{}").get("input") or ""
+            except ValueError:
+                self._reply(400, b"bad json", "text/plain")
+                return
+            stats["requests"] += 1
+            if latency > 0:
+                time.sleep(latency)
+            self._reply(200, audio.for_text(text), "audio/mpeg")
+
+        def do_GET(self):
+            if self.path.startswith("/docs"):
+                self._reply(200, b"stub tts", "text/plain")
+            elif self.path.startswith("/stats"):
+                self._reply(200, json.dumps(stats).encode(), "application/json")
+            else:
+                self._reply(404, b"not found", "text/plain")
+
+        def _reply(self, code: int, payload: bytes, content_type: str) -> None:
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *_args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "5050")))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering each request")
+    parser.add_argument("--ffmpeg", default=shutil.which("ffmpeg") or "ffmpeg")
+    args = parser.parse_args()
+    server = make_server(args.port, args.latency, args.ffmpeg, args.host)
+    print(f"stub TTS listening on http://{args.host}:{args.port} (latency {args.latency}s)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
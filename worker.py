@@ -0,0 +1,125 @@
+"""Standalone render worker for the SQLite job queue.
+
+The web app (started with RENDER_QUEUE_BACKEND=sqlite) only accepts uploads, queues
+jobs and serves results; one or more of these processes on the same host lease jobs
+from RENDER_QUEUE_DB and render them. A worker that crashes or is killed stops
+heartbeating, its lease expires and another worker picks the job up again.
+
+    set RENDER_QUEUE_BACKEND=sqlite
+    python worker.py --concurrency 2
+"""
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+
+os.environ.setdefault("RENDER_QUEUE_BACKEND", "sqlite")
+# Tiến trình web quản lý pool TTS; worker chỉ cân tải giữa các cổng đó
+os.environ.setdefault("DISABLE_TTS_AUTOSTART", "1")
+
+import app  # noqa: E402  (backend phải được chọn trước khi import app)
+
+
+class RenderWorker:
+    def __init__(self, queue, concurrency: int, poll_seconds: float) -> None:
+        self.queue = queue
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+        self._active: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def stop(self, *_args) -> None:
+        # Dừng nhận job mới; job đang render được chạy cho xong
+        if not self._stop.is_set():
+            app.logger.info("render worker %s stopping after current jobs", self.worker_id)
+        self._stop.set()
+
+    def run(self) -> None:
+        threads = [threading.Thread(target=self._loop, name=f"render-worker-{n}") for n in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name="render-heartbeat", daemon=True)
+        heartbeat.start()
+        app.logger.info("render worker %s polling %s (concurrency %d)", self.worker_id, self.queue.path, self.concurrency)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                job = self.queue.lease(self.worker_id)
+            except app.sqlite3.Error:
+                app.logger.exception("render worker %s could not lease a job", self.worker_id)
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_seconds)
+                continue
+            job["cancel"] = threading.Event()
+            with self._lock:
+                self._active[job["id"]] = job
+            app._retention.claim(job["spec"]["workspace"], job["id"])
+            try:
+                result = app._execute_job(job)
+            finally:
+                with self._lock:
+                    self._active.pop(job["id"], None)
+            self._finish(job, result)
+            app._retention.release(job["id"])
+
+    def _finish(self, job: dict, result: dict) -> None:
+        # Mất lease thì job (và workspace của nó) đã thuộc về lần thử khác: không ghi kết quả, không xoá gì
+        if result.get("cancelled"):
+            return
+        try:
+            if result.get("retry") and job["attempt"] < app.RENDER_MAX_ATTEMPTS:
+                # Giữ workspace để lần thử sau còn ảnh đầu vào
+                if not self.queue.retry(job, self.worker_id):
+                    app.logger.warning("render worker %s lost the lease on job %s before retrying it", self.worker_id, job["id"])
+            elif self.queue.complete(job, self.worker_id, result):
+                app._remove_job_workspace(job["spec"].get("workspace"))
+            else:
+                app.logger.warning("render worker %s lost the lease on job %s; dropping its result", self.worker_id, job["id"])
+                app._remove_outputs(result.get("renditions") or [])
+        except app.sqlite3.Error:
+            app.logger.exception("render worker %s could not record job %s", self.worker_id, job["id"])
+
+    def _heartbeat_loop(self) -> None:
+        interval = app.RENDER_LEASE_SECONDS / 3
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                jobs = list(self._active.values())
+            for job in jobs:
+                try:
+                    if not self.queue.heartbeat(job, self.worker_id) and not job["cancel"].is_set():
+                        app.logger.warning("render worker %s lost the lease on job %s; cancelling its render", self.worker_id, job["id"])
+                        job["cancel"].set()
+                except app.sqlite3.Error:
+                    app.logger.exception("heartbeat failed for job %s", job["id"])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Render jobs from the shared SQLite queue.")
+    parser.add_argument("--concurrency", type=int, default=app.RENDER_JOB_CONCURRENCY, help="jobs rendered at once by this process")
+    parser.add_argument("--poll", type=float, default=1.0, help="seconds between queue polls when idle")
+    args = parser.parse_args()
+    if not isinstance(app._job_queue, app._SqliteJobQueue):
+        parser.error("RENDER_QUEUE_BACKEND must be 'sqlite' for standalone workers")
+    app._get_toolchain()
+    app._tts_supervisor.start()
+    worker = RenderWorker(app._job_queue, max(1, args.concurrency), max(0.1, args.poll))
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    try:
+        worker.run()
+    finally:
+        app._tts_supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()